@@ -1,9 +1,14 @@
+from __future__ import annotations
+
 import argparse
 import sys
 import time
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Optional
 
-import cynthionwhisperer
+# The native extension is imported inside each command, so that --help and
+# argument errors don't pay for loading it.
+if TYPE_CHECKING:
+    import cynthionwhisperer
 
 
 def _hex_bytes(value: str, flag_name: str) -> bytes:
@@ -23,18 +28,7 @@ def _int_auto(value: str, flag_name: str) -> int:
         raise ValueError(f"Invalid {flag_name} value: {value}") from error
 
 
-def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
-    parser = argparse.ArgumentParser(
-        description="Capture and trigger utilities for cynthionwhisperer"
-    )
-    parser.add_argument(
-        "--verbose",
-        action="store_true",
-        help="Enable library status logging",
-    )
-    subparsers = parser.add_subparsers(dest="command")
-    subparsers.required = True
-
+def _build_capture_parser(subparsers: argparse._SubParsersAction) -> None:
     capture_parser = subparsers.add_parser(
         "capture",
         help="Capture until a matching DATA packet payload prefix is found",
@@ -62,6 +56,8 @@ def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
         help="Payload prefix as hex bytes (e.g. '20' or '20 01')",
     )
 
+
+def _build_trigger_config_parser(subparsers: argparse._SubParsersAction) -> None:
     trigger_config_parser = subparsers.add_parser(
         "trigger-config",
         help="Configure one trigger stage and optionally arm it",
@@ -110,6 +106,8 @@ def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
         help="Arm trigger after writing config",
     )
 
+
+def _build_trigger_status_parser(subparsers: argparse._SubParsersAction) -> None:
     trigger_status_parser = subparsers.add_parser(
         "trigger-status",
         help="Read trigger status",
@@ -120,6 +118,8 @@ def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
         help="Also print trigger capabilities",
     )
 
+
+def _build_trigger_get_stage_parser(subparsers: argparse._SubParsersAction) -> None:
     trigger_get_stage_parser = subparsers.add_parser(
         "trigger-get-stage",
         help="Read trigger stage configuration",
@@ -130,15 +130,22 @@ def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
         help="Trigger stage index (default: 0)",
     )
 
+
+def _build_trigger_arm_parser(subparsers: argparse._SubParsersAction) -> None:
     subparsers.add_parser(
         "trigger-arm",
         help="Arm trigger state machine",
     )
+
+
+def _build_trigger_disarm_parser(subparsers: argparse._SubParsersAction) -> None:
     subparsers.add_parser(
         "trigger-disarm",
         help="Disarm trigger state machine",
     )
 
+
+def _build_target_power_parser(subparsers: argparse._SubParsersAction) -> None:
     target_power_parser = subparsers.add_parser(
         "target-power",
         help="Read or control target power switching",
@@ -162,7 +169,57 @@ def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
         help="Cycle off delay in milliseconds (default: 250)",
     )
 
-    return parser.parse_args(argv)
+
+# Subparser builders, in the order they are listed by --help.
+_SUBPARSER_BUILDERS: dict[str, Callable[[argparse._SubParsersAction], None]] = {
+    "capture": _build_capture_parser,
+    "trigger-config": _build_trigger_config_parser,
+    "trigger-status": _build_trigger_status_parser,
+    "trigger-get-stage": _build_trigger_get_stage_parser,
+    "trigger-arm": _build_trigger_arm_parser,
+    "trigger-disarm": _build_trigger_disarm_parser,
+    "target-power": _build_target_power_parser,
+}
+
+
+def _sniff_subcommand(argv: list[str]) -> Optional[str]:
+    """Return the subcommand named in argv, or None if all subparsers are needed."""
+    for token in argv:
+        if token in ("-h", "--help"):
+            # Top-level help lists every subcommand.
+            return None
+        if token.startswith("-"):
+            continue
+        return token if token in _SUBPARSER_BUILDERS else None
+    return None
+
+
+def _parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    effective_argv = sys.argv[1:] if argv is None else argv
+
+    parser = argparse.ArgumentParser(
+        description="Capture and trigger utilities for cynthionwhisperer"
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Enable library status logging",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    # Only one command runs per invocation, so only build its subparser.
+    # Missing or unknown commands build them all so argparse can report
+    # the valid choices.
+    command = _sniff_subcommand(effective_argv)
+    if command is None:
+        builders = list(_SUBPARSER_BUILDERS.values())
+    else:
+        builders = [_SUBPARSER_BUILDERS[command]]
+    for build in builders:
+        build(subparsers)
+
+    return parser.parse_args(effective_argv)
 
 
 def _print_trigger_status(analyzer: cynthionwhisperer.Cynthion) -> None:
@@ -190,20 +247,23 @@ def _canonical_source_name(name: str) -> str:
     return cleaned
 
 
-def _resolve_power_source_index(requested: str, sources: list[str]) -> Optional[int]:
-    canonical_sources = [_canonical_source_name(source) for source in sources]
-    requested_name = _canonical_source_name(requested)
+# Old firmware versions may expose HOST instead of CONTROL.
+_POWER_SOURCE_ALIASES = {
+    "CONTROL": "HOST",
+    "HOST": "CONTROL",
+}
 
-    if requested_name in canonical_sources:
-        return canonical_sources.index(requested_name)
 
-    # Old firmware versions may expose HOST instead of CONTROL.
-    if requested_name == "CONTROL" and "HOST" in canonical_sources:
-        return canonical_sources.index("HOST")
-    if requested_name == "HOST" and "CONTROL" in canonical_sources:
-        return canonical_sources.index("CONTROL")
+def _resolve_power_source_index(requested: str, sources: list[str]) -> Optional[int]:
+    # Keep the first index when several sources share a canonical name.
+    source_indices: dict[str, int] = {}
+    for index, source in enumerate(sources):
+        source_indices.setdefault(_canonical_source_name(source), index)
+    requested_name = _canonical_source_name(requested)
 
-    return None
+    if requested_name in source_indices:
+        return source_indices[requested_name]
+    return source_indices.get(_POWER_SOURCE_ALIASES.get(requested_name))
 
 
 _USB_PID_LOW_NIBBLE_TO_NAME = {
@@ -240,11 +300,15 @@ def _cmd_capture(args: argparse.Namespace) -> int:
         print(str(error), file=sys.stderr)
         return 2
 
+    import cynthionwhisperer
+
     analyzer = cynthionwhisperer.Cynthion.open_first()
     capture = analyzer.start_capture(args.speed)
     matched_packet = None
     last_token_direction: Optional[str] = None
     expected_data_pid = args.data_pid.lower() if args.data_pid else None
+    # Events are either Packet or Event objects; pick packets out by type.
+    packet_type = cynthionwhisperer.Packet
 
     try:
         while True:
@@ -253,9 +317,7 @@ def _cmd_capture(args: argparse.Namespace) -> int:
                 continue
             if state == "ended":
                 break
-            if state != "event" or item is None:
-                continue
-            if not hasattr(item, "bytes"):
+            if state != "event" or type(item) is not packet_type:
                 continue
 
             raw = item.bytes
@@ -318,7 +380,7 @@ def _cmd_trigger_config(args: argparse.Namespace) -> int:
         if args.mask_hex is not None:
             mask = _hex_bytes(args.mask_hex, "--mask-hex")
         else:
-            mask = bytes([0xFF] * len(pattern))
+            mask = b"\xff" * len(pattern)
         if len(mask) != len(pattern):
             raise ValueError("--mask-hex length must match --pattern-hex length")
         if args.length is None:
@@ -341,6 +403,11 @@ def _cmd_trigger_config(args: argparse.Namespace) -> int:
     if length < 0 or length > 255:
         print("--length must be in range 0..255", file=sys.stderr)
         return 2
+    if length > len(pattern):
+        print("--length cannot exceed pattern byte count", file=sys.stderr)
+        return 2
+
+    import cynthionwhisperer
 
     analyzer = cynthionwhisperer.Cynthion.open_first()
     max_stages, max_pattern_len, stage_payload_len = analyzer.trigger_caps()
@@ -355,9 +422,6 @@ def _cmd_trigger_config(args: argparse.Namespace) -> int:
             file=sys.stderr,
         )
         return 2
-    if length > len(pattern):
-        print("--length cannot exceed pattern byte count", file=sys.stderr)
-        return 2
     if length > max_pattern_len:
         print(
             f"--length {length} exceeds max_pattern_len {max_pattern_len}",
@@ -394,6 +458,8 @@ def _cmd_trigger_config(args: argparse.Namespace) -> int:
 
 
 def _cmd_trigger_status(args: argparse.Namespace) -> int:
+    import cynthionwhisperer
+
     analyzer = cynthionwhisperer.Cynthion.open_first()
     if args.print_caps:
         max_stages, max_pattern_len, stage_payload_len = analyzer.trigger_caps()
@@ -415,6 +481,8 @@ def _cmd_trigger_get_stage(args: argparse.Namespace) -> int:
         print("--stage-index must be in range 0..255", file=sys.stderr)
         return 2
 
+    import cynthionwhisperer
+
     analyzer = cynthionwhisperer.Cynthion.open_first()
     offset, length, pattern, mask = analyzer.get_trigger_stage(stage_index)
     print(
@@ -425,6 +493,8 @@ def _cmd_trigger_get_stage(args: argparse.Namespace) -> int:
 
 
 def _cmd_trigger_arm() -> int:
+    import cynthionwhisperer
+
     analyzer = cynthionwhisperer.Cynthion.open_first()
     analyzer.arm_trigger()
     print("Trigger armed.")
@@ -433,6 +503,8 @@ def _cmd_trigger_arm() -> int:
 
 
 def _cmd_trigger_disarm() -> int:
+    import cynthionwhisperer
+
     analyzer = cynthionwhisperer.Cynthion.open_first()
     analyzer.disarm_trigger()
     print("Trigger disarmed.")
@@ -441,6 +513,12 @@ def _cmd_trigger_disarm() -> int:
 
 
 def _cmd_target_power(args: argparse.Namespace) -> int:
+    if args.action != "status" and args.delay_ms < 0:
+        print("--delay-ms must be >= 0", file=sys.stderr)
+        return 2
+
+    import cynthionwhisperer
+
     analyzer = cynthionwhisperer.Cynthion.open_first()
     sources = analyzer.power_sources()
     if not sources:
@@ -471,10 +549,6 @@ def _cmd_target_power(args: argparse.Namespace) -> int:
         )
         return 2
 
-    if args.delay_ms < 0:
-        print("--delay-ms must be >= 0", file=sys.stderr)
-        return 2
-
     if args.action == "on":
         analyzer.set_power_config(selected_source_index, True, start_on, stop_off)
         print(f"Target power ON via {sources[selected_source_index]}")
@@ -507,7 +581,12 @@ def _cmd_target_power(args: argparse.Namespace) -> int:
 
 def main() -> int:
     args = _parse_args()
-    cynthionwhisperer.set_verbose(args.verbose)
+    if args.verbose:
+        # Logging is off by default, so the extension only needs loading here
+        # when it is being turned on.
+        import cynthionwhisperer
+
+        cynthionwhisperer.set_verbose(True)
 
     if args.command == "capture":
         return _cmd_capture(args)
@@ -172,6 +172,13 @@ impl Cynthion {
         ))
     }
 
+    fn overrun_counts(&self, py: Python<'_>) -> PyResult<(u32, u32)> {
+        let counts = py
+            .detach(|| block_on(self.inner.overrun_counts()))
+            .map_err(|err| PyRuntimeError::new_err(format!("{err:#}")))?;
+        Ok((counts.overruns, counts.stall_cycles))
+    }
+
     fn get_trigger_stage(
         &self,
         py: Python<'_>,
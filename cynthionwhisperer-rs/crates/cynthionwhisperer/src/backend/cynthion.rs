@@ -43,11 +43,13 @@ const REQUEST_GET_TRIGGER_STATUS: u8 = 9;
 const REQUEST_ARM_TRIGGER: u8 = 10;
 const REQUEST_DISARM_TRIGGER: u8 = 11;
 const REQUEST_GET_TRIGGER_STAGE: u8 = 12;
+const REQUEST_GET_OVERRUN_COUNT: u8 = 13;
 
 const TRIGGER_STAGE_PAYLOAD_LEN: usize = 4 + 32 + 32;
 const TRIGGER_CONTROL_PAYLOAD_LEN: usize = 2;
 const TRIGGER_CAPS_PAYLOAD_LEN: usize = 4;
 const TRIGGER_STATUS_PAYLOAD_LEN: usize = 5;
+const OVERRUN_COUNT_PAYLOAD_LEN: usize = 8;
 const TRIGGER_MAX_PATTERN_LEN: usize = 32;
 
 bitfield! {
@@ -118,6 +120,16 @@ pub struct TriggerStatus {
     pub stage_count: u8,
 }
 
+#[derive(Clone, Debug)]
+pub struct OverrunCounts {
+    /// Captures that lost data to a buffer overrun since the gateware was
+    /// configured.
+    pub overruns: u32,
+    /// Cycles in the current capture on which the HyperRAM buffer held off
+    /// the analyzer's output.
+    pub stall_cycles: u32,
+}
+
 /// A Cynthion device attached to the system.
 #[derive(Clone)]
 pub struct CynthionDevice {
@@ -129,6 +141,8 @@ struct CynthionInner {
     interface: Interface,
     state: State,
     power: Option<PowerConfig>,
+    /// Trigger capabilities, read from the device on first use.
+    trigger_caps: Option<TriggerCaps>,
 }
 
 /// A handle to an open Cynthion device.
@@ -298,6 +312,7 @@ impl CynthionDevice {
                         interface,
                         state,
                         power,
+                        trigger_caps: None,
                     })),
                     speeds,
                     metadata,
@@ -506,6 +521,13 @@ impl CynthionHandle {
         Ok(())
     }
 
+    fn ensure_overrun_count_supported(&self) -> Result<(), Error> {
+        if self.protocol_minor < 3 {
+            bail!("Overrun count not supported by this gateware version.")
+        }
+        Ok(())
+    }
+
     pub async fn configure_test_device(&mut self, speed: Option<Speed>) -> Result<(), Error> {
         let test_config = TestConfig::new(speed);
         self.inner()
@@ -518,6 +540,10 @@ impl CynthionHandle {
     pub async fn trigger_caps(&self) -> Result<TriggerCaps, Error> {
         self.ensure_trigger_supported()?;
         let mut inner = self.inner().await;
+        // Capabilities are fixed by the gateware, so only ask the device once.
+        if let Some(caps) = &inner.trigger_caps {
+            return Ok(caps.clone());
+        }
         let data = inner
             .read_request(REQUEST_GET_TRIGGER_CAPS, 0, 64)
             .await
@@ -528,11 +554,13 @@ impl CynthionHandle {
                 data.len()
             );
         }
-        Ok(TriggerCaps {
+        let caps = TriggerCaps {
             max_stages: data[0],
             max_pattern_len: data[1],
             stage_payload_len: u16::from_le_bytes([data[2], data[3]]),
-        })
+        };
+        inner.trigger_caps = Some(caps.clone());
+        Ok(caps)
     }
 
     pub async fn set_trigger_control(&mut self, control: TriggerControl) -> Result<(), Error> {
@@ -663,6 +691,25 @@ impl CynthionHandle {
         })
     }
 
+    pub async fn overrun_counts(&self) -> Result<OverrunCounts, Error> {
+        self.ensure_overrun_count_supported()?;
+        let mut inner = self.inner().await;
+        let data = inner
+            .read_request(REQUEST_GET_OVERRUN_COUNT, 0, 64)
+            .await
+            .context("Failed to read overrun counts")?;
+        if data.len() != OVERRUN_COUNT_PAYLOAD_LEN {
+            bail!(
+                "Expected {OVERRUN_COUNT_PAYLOAD_LEN}-byte overrun counts response, got {}",
+                data.len()
+            );
+        }
+        Ok(OverrunCounts {
+            overruns: u32::from_le_bytes([data[0], data[1], data[2], data[3]]),
+            stall_cycles: u32::from_le_bytes([data[4], data[5], data[6], data[7]]),
+        })
+    }
+
     pub async fn arm_trigger(&mut self) -> Result<(), Error> {
         self.ensure_trigger_supported()?;
         let mut inner = self.inner().await;
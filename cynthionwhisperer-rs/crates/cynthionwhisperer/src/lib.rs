@@ -121,6 +121,10 @@ impl Cynthion {
         self.handle.trigger_status().await
     }
 
+    pub async fn overrun_counts(&self) -> Result<crate::backend::cynthion::OverrunCounts> {
+        self.handle.overrun_counts().await
+    }
+
     pub async fn arm_trigger(&mut self) -> Result<()> {
         self.handle.arm_trigger().await
     }
@@ -170,7 +174,7 @@ pub use crate::usb::validate_packet;
 pub use crate::{
     backend::PowerConfig,
     backend::TimestampedEvent,
-    backend::cynthion::{TriggerCaps, TriggerControl, TriggerStage, TriggerStatus},
+    backend::cynthion::{OverrunCounts, TriggerCaps, TriggerControl, TriggerStage, TriggerStatus},
     capture::CaptureMetadata,
     event::EventType,
     usb::PID,
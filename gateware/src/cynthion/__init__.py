@@ -2,6 +2,8 @@
 
 """Minimal Cynthion package shim for standalone analyzer gateware builds."""
 
+import importlib
+
 # Provide vendored amaranth_boards resources if the package is unavailable.
 try:
     import amaranth_boards  # noqa: F401
@@ -11,7 +13,13 @@ except Exception:
 
     sys.modules["amaranth_boards"] = amaranth_boards_vendor
 
-from . import gateware
-from . import shared
-
 __all__ = ["gateware", "shared"]
+
+
+def __getattr__(name):
+    # Import subpackages on first access rather than with the package.
+    if name in __all__:
+        module = importlib.import_module(f".{name}", __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,9 +6,15 @@
 
 """ Low-level USB analyzer gateware. """
 
+import difflib
+import struct
 import unittest
+from types import SimpleNamespace
 
-from amaranth          import Signal, Module, Elaboratable, Memory, Record, Mux, Cat, C, Array
+from amaranth          import Signal, Module, Elaboratable, Memory, Record, Mux, Cat, C, ResetInserter, DomainRenamer
+
+from amaranth.lib.fifo import SyncFIFOBuffered
+from amaranth.sim      import Delay
 
 from luna.gateware.stream import StreamInterface
 from luna.gateware.test   import LunaGatewareTestCase, usb_domain_test_case
@@ -38,24 +44,19 @@ class _DefaultTriggerConfig:
         self.output_enable = Signal(reset=0)
         self.stage_count = Signal(range(self.max_stages + 1), reset=0)
 
-        self.stage_offsets = Array(
-            Signal(16, name=f"default_trigger_stage_{i}_offset")
-            for i in range(self.max_stages)
-        )
-        self.stage_lengths = Array(
-            Signal(8, name=f"default_trigger_stage_{i}_length")
-            for i in range(self.max_stages)
-        )
-        self.patterns_flat = Array(
-            Signal(8, name=f"default_trigger_pattern_{i}")
-            for i in range(self.max_stages * self.max_pattern)
-        )
-        self.masks_flat = Array(
-            Signal(8, reset=0xFF, name=f"default_trigger_mask_{i}")
-            for i in range(self.max_stages * self.max_pattern)
-        )
+        # Stage table; each word holds a 16-bit offset followed by an 8-bit
+        # length, written per byte lane.
+        self.stage_memory = Memory(width=24, depth=self.max_stages,
+            init=[0] * self.max_stages, name="default_trigger_stages")
+        self.stage_write_en = Signal(3)
+        self.stage_write_addr = Signal(range(self.max_stages))
+        self.stage_write_data = Signal(24)
 
+        # Pattern table; each word holds a pattern byte in its low lane and the
+        # matching mask byte in its high lane. Masks default to all-ones.
         flat_depth = self.max_stages * self.max_pattern
+        self.pattern_memory = Memory(width=16, depth=flat_depth,
+            init=[0xFF00] * flat_depth, name="default_trigger_patterns")
         self.pattern_write_en = Signal()
         self.pattern_write_addr = Signal(range(flat_depth))
         self.pattern_write_data = Signal(8)
@@ -94,6 +95,11 @@ class USBAnalyzer(Elaboratable):
         Asserted iff the analyzer is starting capture on this cycle.
     capture_start_strobe: Signal(), output
         Asserted iff the analyzer is emitting the capture-start event on this cycle.
+    current_time: Signal(16), output
+        The timestamp counter; cycles elapsed since the last packet or event.
+    current_time_load: Signal(), input
+        When asserted, loads :attr:``current_time_load_value`` into the timestamp counter.
+        Intended for simulation, to skip over idle time; leave deasserted in hardware.
 
 
     Parameters
@@ -157,6 +163,10 @@ class USBAnalyzer(Elaboratable):
         self.capturing      = Signal()
         self.starting       = Signal()
         self.capture_start_strobe = Signal()
+        self.current_time   = Signal(16)
+
+        self.current_time_load       = Signal()
+        self.current_time_load_value = Signal(16)
 
         self.trigger_output = Signal()
         self.trigger_fire_strobe = Signal()
@@ -171,16 +181,23 @@ class USBAnalyzer(Elaboratable):
         m.submodules.read  = mem_read_port  = self.mem.read_port(domain="sync", transparent=False)
         m.submodules.write = mem_write_port = self.mem.write_port(domain="sync", granularity=8)
 
-        # FIFO write addresses point to bytes.
-        write_byte_addr  = Signal(range(self.mem_size_bytes))
+        # FIFO write addresses point to bytes. Like the FIFO's head and tail,
+        # the write address carries one bit beyond the memory's address range,
+        # so that a full buffer can be told apart from an empty one; each is
+        # only truncated when it is used to index memory.
+        write_byte_addr  = Signal(range(2 * self.mem_size_bytes))
 
         # Memory addresses point to words
         header_word_addr = Signal.like(mem_write_port.addr)
         write_word_addr  = Signal.like(mem_write_port.addr)
-        read_word_addr   = Signal.like(mem_read_port.addr)
-        fifo_word_count  = Signal.like(mem_read_port.addr)
+        write_head       = Signal(range(2 * self.mem_size_words))
+        read_tail        = Signal.like(write_head)
+        fifo_word_count  = Signal.like(write_head)
         write_odd        = Signal()
-        m.d.comb += Cat(write_odd, write_word_addr).eq(write_byte_addr)
+        m.d.comb += [
+            Cat(write_odd, write_word_addr).eq(write_byte_addr),
+            fifo_word_count.eq(write_head - read_tail),
+        ]
 
         # Current receive status.
         packet_size     = Signal(16)
@@ -194,45 +211,47 @@ class USBAnalyzer(Elaboratable):
         write_event     = Signal()
 
         # Trigger matching state.
-        packet_byte_index = Signal(range(self.MAX_PACKET_SIZE_BYTES + 1))
         stage_mismatch = Signal()
         stage_match_count = Signal(range(self.trigger.max_pattern + 1))
+        stage_match_next = Signal.like(stage_match_count)
         seq_expected_stage = Signal(range(self.trigger.max_stages + 1))
         pending_trigger_event = Signal()
-        pending_stage_compare = Signal()
-        pending_stage_byte = Signal(8)
         trigger_output_pulse_cycles = Signal(range(TRIGGER_OUTPUT_PULSE_CYCLES + 1))
 
         active_stage_index = Signal(range(self.trigger.max_stages))
         active_stage_offset = Signal(16)
         active_stage_len_raw = Signal(8)
         active_stage_len = Signal(8)
+        active_stage_end = Signal(17)
+        active_stage_valid_pre = Signal()
         active_stage_valid = Signal()
 
         stage_window_hit = Signal()
-        pattern_index = Signal(range(self.trigger.max_pattern))
         pattern_flat_index = Signal(range(self.trigger.max_stages * self.trigger.max_pattern))
-        pending_stage_mismatch = Signal()
-        stage_mismatch_effective = Signal()
-
-        # Pattern/mask memories let synthesis map match tables into BRAM
-        # rather than wide mux trees from dynamic Array indexing.
-        flat_depth = self.trigger.max_stages * self.trigger.max_pattern
-        pattern_memory = Memory(width=8, depth=flat_depth, init=[0] * flat_depth)
-        mask_memory = Memory(width=8, depth=flat_depth, init=[0xFF] * flat_depth)
+        byte_mismatch = Signal()
+
+        # The trigger config owns the stage and pattern/mask tables, so that
+        # synthesis can map them into RAM rather than wide mux trees from
+        # dynamic Array indexing. The stage table is read continuously for
+        # the current stage.
+        m.submodules.stage_read_port = stage_read_port = \
+            self.trigger.stage_memory.read_port(domain="usb", transparent=False)
+        m.submodules.stage_write_port = stage_write_port = \
+            self.trigger.stage_memory.write_port(domain="usb", granularity=8)
         m.submodules.pattern_read_port = pattern_read_port = \
-            pattern_memory.read_port(domain="usb", transparent=False)
-        m.submodules.mask_read_port = mask_read_port = \
-            mask_memory.read_port(domain="usb", transparent=False)
+            self.trigger.pattern_memory.read_port(domain="usb", transparent=False)
         m.submodules.pattern_write_port = pattern_write_port = \
-            pattern_memory.write_port(domain="usb")
-        m.submodules.mask_write_port = mask_write_port = \
-            mask_memory.write_port(domain="usb")
+            self.trigger.pattern_memory.write_port(domain="usb", granularity=8)
 
         m.d.comb += [
             active_stage_index.eq(seq_expected_stage[0:self.trigger.stage_bits]),
-            active_stage_offset.eq(self.trigger.stage_offsets[active_stage_index]),
-            active_stage_len_raw.eq(self.trigger.stage_lengths[active_stage_index]),
+            stage_read_port.en.eq(1),
+            stage_read_port.addr.eq(active_stage_index),
+            active_stage_offset.eq(stage_read_port.data[0:16]),
+            active_stage_len_raw.eq(stage_read_port.data[16:24]),
+            stage_write_port.en.eq(self.trigger.stage_write_en),
+            stage_write_port.addr.eq(self.trigger.stage_write_addr),
+            stage_write_port.data.eq(self.trigger.stage_write_data),
             active_stage_len.eq(
                 Mux(
                     active_stage_len_raw > self.trigger.max_pattern,
@@ -240,127 +259,170 @@ class USBAnalyzer(Elaboratable):
                     active_stage_len_raw,
                 )
             ),
-            active_stage_valid.eq(
-                self.trigger.enable &
-                self.trigger.armed &
-                (seq_expected_stage < self.trigger.stage_count) &
-                (seq_expected_stage < self.trigger.max_stages)
-            ),
             stage_window_hit.eq(
                 active_stage_valid &
-                (packet_byte_index >= active_stage_offset) &
-                (packet_byte_index < (active_stage_offset + active_stage_len))
+                (packet_size >= active_stage_offset) &
+                (packet_size < active_stage_end)
             ),
-            pattern_index.eq(packet_byte_index - active_stage_offset),
-            pattern_flat_index.eq(active_stage_index * self.trigger.max_pattern + pattern_index),
-            pattern_read_port.en.eq(stage_window_hit),
+            # A stage's bytes are compared in order, so read out the entry for
+            # its next byte ahead of time; each received byte is then compared
+            # in the cycle it arrives. Once a byte has mismatched the stage can
+            # no longer match, so stop reading until the next packet.
+            pattern_flat_index.eq(active_stage_index * self.trigger.max_pattern + stage_match_next),
+            pattern_read_port.en.eq(~stage_mismatch | new_packet),
             pattern_read_port.addr.eq(pattern_flat_index),
-            mask_read_port.en.eq(stage_window_hit),
-            mask_read_port.addr.eq(pattern_flat_index),
-            pattern_write_port.en.eq(self.trigger.pattern_write_en),
-            pattern_write_port.addr.eq(self.trigger.pattern_write_addr),
-            pattern_write_port.data.eq(self.trigger.pattern_write_data),
-            mask_write_port.en.eq(self.trigger.mask_write_en),
-            mask_write_port.addr.eq(self.trigger.mask_write_addr),
-            mask_write_port.data.eq(self.trigger.mask_write_data),
-            pending_stage_mismatch.eq(
-                (pending_stage_byte & mask_read_port.data) !=
-                (pattern_read_port.data & mask_read_port.data)
+            byte_mismatch.eq(
+                ((self.utmi.rx_data ^ pattern_read_port.data[0:8]) & pattern_read_port.data[8:16]).any()
+            ),
+            # Host writes arrive one byte at a time; pattern writes take
+            # priority for the address if both are ever strobed together.
+            pattern_write_port.en.eq(Cat(self.trigger.pattern_write_en, self.trigger.mask_write_en)),
+            pattern_write_port.addr.eq(
+                Mux(
+                    self.trigger.pattern_write_en,
+                    self.trigger.pattern_write_addr,
+                    self.trigger.mask_write_addr,
+                )
+            ),
+            pattern_write_port.data.eq(
+                Cat(self.trigger.pattern_write_data, self.trigger.mask_write_data)
             ),
-            stage_mismatch_effective.eq(stage_mismatch | (pending_stage_compare & pending_stage_mismatch)),
             self.trigger_sequence_stage.eq(seq_expected_stage),
             self.trigger_output.eq(trigger_output_pulse_cycles != 0),
         ]
 
-        # Use the FIFO as our stream source.
-        m.d.comb += self.stream.payload.eq(mem_read_port.data)
-        with m.If(~self.stream.valid | self.stream.ready):
-            # The stream produces the next word when there is data in the FIFO.
-            m.d.comb += [
-                mem_read_port.en    .eq(fifo_word_count != 0)
+        # The stage's end offset is registered from the stage table read, so it
+        # settles two cycles after the stage index changes; delay the stage's
+        # validity by the same amount to keep them in step.
+        m.d.usb += [
+            active_stage_end.eq(active_stage_offset + active_stage_len),
+            active_stage_valid_pre.eq(
+                self.trigger.enable &
+                self.trigger.armed &
+                (seq_expected_stage < self.trigger.stage_count) &
+                (seq_expected_stage < self.trigger.max_stages)
+            ),
+            active_stage_valid.eq(active_stage_valid_pre),
+        ]
+
+        # The FSM sets the next match count, so the pattern read can follow it.
+        m.d.comb += stage_match_next.eq(stage_match_count)
+        m.d.usb += stage_match_count.eq(stage_match_next)
+
+        # Use the FIFO as our stream source. Each word read waits in the memory's
+        # output register until a skid register that drives the stream can take
+        # it, so the memory output never feeds the consumer directly.
+        read_valid      = Signal()
+        read_last       = Signal()
+        payload_q       = Signal.like(self.stream.payload)
+        payload_q_valid = Signal()
+        payload_q_last  = Signal()
+        payload_load    = Signal()
+        m.d.comb += [
+            self.stream.payload .eq(payload_q),
+            self.stream.valid   .eq(payload_q_valid),
+            self.stream.last    .eq(payload_q_last),
+
+            # The skid register takes the word read whenever it is empty or
+            # its current word is being accepted.
+            payload_load        .eq(read_valid & (~payload_q_valid | self.stream.ready)),
+
+            # The stream reads the next word when there is data in the FIFO,
+            # and the previous word read has been, or is being, moved on.
+            mem_read_port.en    .eq((write_head != read_tail) & (~read_valid | payload_load)),
+        ]
+        with m.If(payload_load):
+            m.d.sync += [
+                payload_q       .eq(mem_read_port.data),
+                payload_q_valid .eq(1),
+                payload_q_last  .eq(read_last),
             ]
+        with m.Elif(self.stream.ready):
+            m.d.sync += payload_q_valid.eq(0)
+
+        with m.If(mem_read_port.en):
             m.d.sync += [
-                self.stream.valid   .eq(mem_read_port.en),
-                self.stream.last    .eq(fifo_word_count == 1),
+                read_valid      .eq(1),
+                read_last       .eq(fifo_word_count == 1),
             ]
-        with m.Else():
-            m.d.comb += mem_read_port.en.eq(0)
+        with m.Elif(payload_load):
+            m.d.sync += read_valid.eq(0)
 
         # When a word is read from the FIFO, move to the next address.
-        m.d.comb += mem_read_port.addr.eq(read_word_addr)
+        m.d.comb += mem_read_port.addr.eq(read_tail)
         with m.If(mem_read_port.en):
-            m.d.sync += read_word_addr.eq(read_word_addr + 1)
+            m.d.sync += read_tail.eq(read_tail + 1)
 
         #
         # FIFO count handling.
         #
 
-        # Number of words popped from the FIFO this cycle.
-        fifo_words_popped = Signal(1)
-
-        # Number of uncommitted words and its push trigger.
-        fifo_words_pending = Signal(11)
+        # Committed words lie between the read tail and the write head; the
+        # head only advances when a packet or event is committed.
         data_commit  = Signal()
 
-        # One word is popped if the FIFO stream is read.
-        m.d.comb += fifo_words_popped.eq(mem_read_port.en)
+        # Words in use, including those of a packet still being written.
+        next_write_word = Signal.like(write_head)
+        fifo_words_used = Signal.like(write_head)
+        m.d.comb += [
+            next_write_word.eq((write_byte_addr + write_odd)[1:]),
+            fifo_words_used.eq(next_write_word - read_tail),
+        ]
 
-        # On startup, set counts to zero.
+        # On startup, empty the FIFO.
         with m.If(self.starting & ~data_commit):
             m.d.sync += [
-                self.stream.valid.eq(0),
+                read_valid.eq(0),
+                payload_q_valid.eq(0),
                 write_byte_addr.eq(0),
-                fifo_word_count.eq(0),
-                read_word_addr.eq(0),
-                fifo_words_pending.eq(0),
+                write_head.eq(0),
+                read_tail.eq(0),
             ]
-        # Otherwise, update the count acording to words pushed and popped.
-        with m.Else():
-            fifo_next_count = fifo_word_count - fifo_words_popped
-            with m.If(data_commit):
-                m.d.sync += fifo_word_count.eq(fifo_next_count + fifo_words_pending)
-            with m.Else():
-                m.d.sync += fifo_word_count.eq(fifo_next_count)
 
 
-        # Timestamp counter.
-        current_time = Signal(16)
-        m.d.usb += [
-            current_time.eq(current_time + 1),
-            self.trigger_fire_strobe.eq(0),
-        ]
+        # Timestamp counter. It is held at zero while stopped, so only count
+        # once capture has started.
+        current_time = self.current_time
+        with m.If(~self.stopped):
+            m.d.usb += current_time.eq(current_time + 1)
+        m.d.usb += self.trigger_fire_strobe.eq(0)
         with m.If(trigger_output_pulse_cycles > 0):
             m.d.usb += trigger_output_pulse_cycles.eq(trigger_output_pulse_cycles - 1)
 
+        # Set when the buffer overruns; capture then waits in AWAIT_START
+        # until the host stops it.
+        overrun_latched = Signal()
+
         #
         # Core analysis FSM.
         #
         with m.FSM(domain="usb") as f:
             m.d.comb += [
-                self.idle      .eq(f.ongoing("AWAIT_START") | f.ongoing("AWAIT_PACKET")),
-                self.stopped   .eq(f.ongoing("AWAIT_START")),
-                self.overrun   .eq(f.ongoing("OVERRUN")),
+                self.idle      .eq(self.stopped | f.ongoing("AWAIT_PACKET")),
+                self.stopped   .eq(f.ongoing("AWAIT_START") & ~overrun_latched),
+                self.overrun   .eq(overrun_latched),
                 self.capturing .eq(f.ongoing("CAPTURE_PACKET")),
                 self.starting  .eq(self.stopped & self.capture_enable),
                 self.capture_start_strobe.eq(
-                    f.ongoing("AWAIT_START") &
+                    self.stopped &
                     self.capture_enable &
                     ~self.utmi.rx_active
                 ),
             ]
 
             # AWAIT_START: wait for capture to be enabled, but don't start mid-packet.
+            # After an overrun, wait for the host to stop capture first.
             with m.State("AWAIT_START"):
+                with m.If(~self.capture_enable):
+                    m.d.usb += overrun_latched.eq(0)
                 m.d.usb += [
                     current_time.eq(0),
-                    packet_byte_index.eq(0),
                     stage_mismatch.eq(0),
-                    stage_match_count.eq(0),
-                    pending_stage_compare.eq(0),
                     seq_expected_stage.eq(0),
                     pending_trigger_event.eq(0),
                 ]
-                with m.If(self.capture_enable & ~self.utmi.rx_active):
+                m.d.comb += stage_match_next.eq(0)
+                with m.If(self.capture_enable & ~self.utmi.rx_active & ~overrun_latched):
                     # Capture is being started.
                     m.next = "AWAIT_PACKET"
                     m.d.usb += current_time.eq(0)
@@ -406,16 +468,16 @@ class USBAnalyzer(Elaboratable):
                     self.utmi.rx_active &
                     self.session_valid
                 ):
-                    m.d.comb += new_packet.eq(1)
+                    m.d.comb += [
+                        new_packet         .eq(1),
+                        stage_match_next   .eq(0),
+                    ]
                     m.next = "CAPTURE_PACKET"
                     m.d.usb += [
                         packet_size        .eq(0),
                         packet_time        .eq(current_time),
                         current_time       .eq(0),
-                        packet_byte_index  .eq(0),
                         stage_mismatch     .eq(0),
-                        stage_match_count  .eq(0),
-                        pending_stage_compare.eq(0),
                     ]
                 with m.Elif(self.event_strobe):
                     # Event detected externally.
@@ -440,10 +502,6 @@ class USBAnalyzer(Elaboratable):
 
                 byte_received = self.utmi.rx_valid & self.utmi.rx_active
 
-                m.d.usb += pending_stage_compare.eq(0)
-                with m.If(pending_stage_compare & pending_stage_mismatch):
-                    m.d.usb += stage_mismatch.eq(1)
-
                 # Capture data whenever RxValid is asserted.
                 m.d.comb += [
                     write_packet    .eq(byte_received),
@@ -451,22 +509,18 @@ class USBAnalyzer(Elaboratable):
 
                 # Advance the write pointer each time we receive a bit.
                 with m.If(byte_received):
-                    m.d.usb += [
-                        packet_size        .eq(packet_size + 1),
-                        packet_byte_index  .eq(packet_byte_index + 1),
-                    ]
+                    m.d.usb += packet_size.eq(packet_size + 1)
 
-                    with m.If(stage_window_hit):
-                        m.d.usb += [
-                            stage_match_count.eq(stage_match_count + 1),
-                            pending_stage_compare.eq(1),
-                            pending_stage_byte.eq(self.utmi.rx_data),
-                        ]
+                    with m.If(stage_window_hit & ~stage_mismatch):
+                        m.d.comb += stage_match_next.eq(stage_match_count + 1)
+                        with m.If(byte_mismatch):
+                            m.d.usb += stage_mismatch.eq(1)
 
                     # If this would be filling up our data memory,
-                    # move to the OVERRUN state.
-                    with m.If(fifo_word_count + fifo_words_pending == self.mem_size_words - 1):
-                        m.next = "OVERRUN"
+                    # stop capturing until the host restarts capture.
+                    with m.If(fifo_words_used == self.mem_size_words - 1):
+                        m.d.usb += overrun_latched.eq(1)
+                        m.next = "AWAIT_START"
 
                 # If we've stopped receiving, write header.
                 with m.If(~self.utmi.rx_active):
@@ -477,9 +531,9 @@ class USBAnalyzer(Elaboratable):
                     with m.If(
                         active_stage_valid &
                         (active_stage_len > 0) &
-                        ~stage_mismatch_effective &
+                        ~stage_mismatch &
                         (stage_match_count == active_stage_len) &
-                        (packet_size >= (active_stage_offset + active_stage_len))
+                        (packet_size >= active_stage_end)
                     ):
                         with m.If((seq_expected_stage + 1) >= self.trigger.stage_count):
                             m.d.usb += [
@@ -496,20 +550,9 @@ class USBAnalyzer(Elaboratable):
                     m.next = "AWAIT_PACKET"
 
 
-            # BABBLE -- handles the case in which we've received a packet beyond
-            # the allowable size in the USB spec
-            with m.State("BABBLE"):
-
-                # Trap here, for now.
-                pass
-
-
-            with m.State("OVERRUN"):
-                # TODO: we should probably set an overrun flag and then emit an EOP, here?
-
-                # If capture is stopped by the host, reset back to the ready state.
-                with m.If(~self.capture_enable):
-                    m.next = "AWAIT_START"
+        # Preloading the timestamp counter takes priority over the FSM.
+        with m.If(self.current_time_load):
+            m.d.usb += current_time.eq(self.current_time_load_value)
 
 
         #
@@ -518,17 +561,24 @@ class USBAnalyzer(Elaboratable):
         next_byte_addr_aligned = Mux(self.starting, 0, write_byte_addr + write_odd)
         next_word_addr = next_byte_addr_aligned[1:]
 
+        # Second word of a header or event, written during FINISH.
+        finish_word_en   = Signal()
+        finish_word_data = Signal(16)
+
+        # Write requests come from the usb domain and so are held for two
+        # sync cycles. Each request is handled in START, and FINISH covers
+        # the second cycle of the request, finishing any two-word write.
         with m.FSM(domain="sync"):
             # START: Begin write operation when requested.
             with m.State("START"):
+                m.d.sync += finish_word_en.eq(0)
                 with m.If(new_packet):
                     # Allocate new packet header.
                     m.d.sync += [
                         header_word_addr     .eq(next_word_addr),
-                        fifo_words_pending   .eq(self.HEADER_SIZE_WORDS),
                         write_byte_addr      .eq(next_byte_addr_aligned + self.HEADER_SIZE_BYTES),
                     ]
-                    m.next = "IDLE"
+                    m.next = "FINISH"
                 with m.Elif(write_packet):
                     # Write packet byte.
                     m.d.comb += [
@@ -536,21 +586,22 @@ class USBAnalyzer(Elaboratable):
                         mem_write_port.data  .eq(self.utmi.rx_data.replicate(2)),
                         mem_write_port.en    .eq(Mux(write_odd, 0b01, 0b10)),
                     ]
-                    m.d.sync += [
-                        fifo_words_pending   .eq(fifo_words_pending + ~write_odd),
-                        write_byte_addr      .eq(write_byte_addr + 1),
-                    ]
-                    m.next = "IDLE"
+                    m.d.sync += write_byte_addr.eq(write_byte_addr + 1)
+                    m.next = "FINISH"
                 with m.Elif(write_header):
-                    # Write first word of header.
+                    # Write first word of header; the timestamp follows.
                     m.d.comb += [
                         mem_write_port.addr  .eq(header_word_addr),
                         mem_write_port.data  .eq(packet_size),
                         mem_write_port.en    .eq(0b11)
                     ]
-                    m.next = "FINISH_HEADER"
+                    m.d.sync += [
+                        finish_word_en       .eq(1),
+                        finish_word_data     .eq(packet_time),
+                    ]
+                    m.next = "FINISH"
                 with m.Elif(write_event):
-                    # Write event identifier and event code.
+                    # Write event identifier and event code; the timestamp follows.
                     m.d.comb += [
                         mem_write_port.addr  .eq(next_word_addr),
                         mem_write_port.data  .eq(Cat(event_code, C(0xFF, 8))),
@@ -558,37 +609,41 @@ class USBAnalyzer(Elaboratable):
                     ]
                     m.d.sync += [
                         header_word_addr     .eq(next_word_addr),
-                        fifo_words_pending   .eq(self.EVENT_SIZE_WORDS),
                         write_byte_addr      .eq(next_byte_addr_aligned + self.EVENT_SIZE_BYTES),
+                        finish_word_en       .eq(1),
+                        finish_word_data     .eq(current_time),
                     ]
-                    m.next = "FINISH_EVENT"
+                    m.next = "FINISH"
 
-            # FINISH_HEADER: Write second word of header.
-            with m.State("FINISH_HEADER"):
-                m.d.comb += [
+            # FINISH: Write the second word of a header or event, if any.
+            with m.State("FINISH"):
+                with m.If(finish_word_en):
+                    m.d.comb += [
                         mem_write_port.addr  .eq(header_word_addr + 1),
-                        mem_write_port.data  .eq(packet_time),
+                        mem_write_port.data  .eq(finish_word_data),
                         mem_write_port.en    .eq(0b11),
                         data_commit          .eq(1),
-                ]
+                    ]
+                    m.d.sync += write_head.eq(next_write_word)
                 m.next = "START"
 
-            # FINISH_EVENT: Write second word of event.
-            with m.State("FINISH_EVENT"):
-                m.d.comb += [
-                        mem_write_port.addr  .eq(header_word_addr + 1),
-                        mem_write_port.data  .eq(current_time),
-                        mem_write_port.en    .eq(0b11),
-                        data_commit          .eq(1),
-                ]
-                m.next = "START"
 
-            # IDLE: Nothing to do this cycle.
-            with m.State("IDLE"):
-                m.next = "START"
+        return m
 
 
-        return m
+# Events expected on the analyzer's output stream. Capture always starts with
+# a high-speed start event, timestamped zero.
+START_EVENT       = struct.pack(">BBH", 0xFF, USBAnalyzerEvent.CAPTURE_START_HIGH, 0x0000)
+ROLLOVER_EVENT    = struct.pack(">BBH", 0xFF, USBAnalyzerEvent.NONE, 0xFFFF)
+STOP_EVENT_PREFIX = struct.pack(">BB", 0xFF, USBAnalyzerEvent.CAPTURE_STOP_NORMAL)
+
+# Single-stage trigger pattern, and the packet payloads sent against it.
+TRIGGER_TEST_PATTERN = b"\xaa\xbb\xcc"
+TRIGGER_TEST_CASES = (
+    ("match",               b"\xaa\xbb\xcc", True),
+    ("second byte differs", b"\xaa\x99\xcc", False),
+    ("final byte differs",  b"\xaa\xbb\x99", False),
+)
 
 
 class USBAnalyzerTestBase(LunaGatewareTestCase):
@@ -596,32 +651,103 @@ class USBAnalyzerTestBase(LunaGatewareTestCase):
     SYNC_CLOCK_FREQUENCY = 120e6
     USB_CLOCK_FREQUENCY = 60e6
 
-    def expect_data(self, expected_data):
-        # Check the stream reports data available.
-        self.assertEqual((yield self.stream.valid), 1)
+    # Longest run of cycles the output stream may go without a byte before
+    # expect_data gives up on it.
+    STREAM_TIMEOUT_CYCLES = 32
 
-        # Check that the expected data is set up.
-        self.assertEqual((yield self.stream.payload), expected_data[0])
+    def attach_output_pipeline(self, m):
+        # Follow the analyzer with the applet's output pipeline, less the
+        # HyperRAM: the ingress FIFO carrying each word with its `last` flag,
+        # a 16-bit sync to usb clock converter, then Stream16to8 in the usb
+        # domain.
+        analyzer_stream = self.analyzer.stream
+        reset_on_start = ResetInserter(self.analyzer.starting)
+        m.submodules.ingress_fifo = ingress_fifo = reset_on_start(
+            SyncFIFOBuffered(width=17, depth=32))
+        m.submodules.clk_conv = clk_conv = StreamFIFO(
+            AsyncFIFOReadReset(width=16, depth=16, r_domain="usb", w_domain="sync"))
+        m.submodules.s16to8 = s16to8 = ResetInserter({"usb": self.analyzer.starting})(
+            DomainRenamer("usb")(Stream16to8()))
+        m.d.comb += [
+            ingress_fifo.w_data.eq(Cat(analyzer_stream.payload, analyzer_stream.last)),
+            ingress_fifo.w_en.eq(analyzer_stream.valid),
+            analyzer_stream.ready.eq(ingress_fifo.w_rdy),
+            clk_conv.input.payload.eq(ingress_fifo.r_data[0:16]),
+            clk_conv.input.valid.eq(ingress_fifo.r_rdy),
+            ingress_fifo.r_en.eq(clk_conv.input.ready),
+            clk_conv.fifo.ext_rst.eq(self.analyzer.starting),
+            s16to8.input.stream_eq(clk_conv.output),
+        ]
+        self.ingress_fifo = ingress_fifo
+        self.stream = s16to8.output
+
+        # Count the words flagged `last` entering and leaving the ingress
+        # FIFO, so tests can check the flag makes it through.
+        self.last_words_in  = Signal(8)
+        self.last_words_out = Signal(8)
+        with m.If(analyzer_stream.valid & analyzer_stream.ready & analyzer_stream.last):
+            m.d.sync += self.last_words_in.eq(self.last_words_in + 1)
+        with m.If(ingress_fifo.r_rdy & ingress_fifo.r_en & ingress_fifo.r_data[16]):
+            m.d.sync += self.last_words_out.eq(self.last_words_out + 1)
 
-        # Signal that we are ready to receive data.
-        yield self.stream.ready.eq(1)
+    def initialize_signals(self):
+        # Every test starts with capture enabled.
+        yield self.analyzer.capture_enable.eq(1)
         yield
 
-        # Validate that we get all of the bytes we expected.
-        received_data = []
-        for datum in expected_data:
+    def advance_cycles(self, cycles):
+        # Wait out idle stretches with a single simulator command, rather than
+        # one process step per cycle. Delaying to a half-period before the
+        # final edge keeps the process aligned to the usb clock.
+        if cycles:
+            period = 1 / self.USB_CLOCK_FREQUENCY
+            yield Delay((cycles - 0.5) * period)
+            yield
+
+    def drive_waveform(self, signal, waveform):
+        # Apply a fixed stimulus, holding each value for its number of cycles.
+        for value, cycles in waveform:
+            yield signal.eq(value)
+            for _ in range(cycles):
+                yield
+
+    @staticmethod
+    def hex_diff(expected, received):
+        # Line-by-line diff of two hex dumps, eight bytes to a line.
+        def dump(data):
+            return [f"{i:04x}: {data[i:i + 8].hex(' ')}" for i in range(0, len(data), 8)]
+        return "\n".join(difflib.ndiff(dump(expected), dump(received)))
+
+    def receive_bytes(self, count):
+        # Accept up to `count` bytes from the stream, riding out the gaps the
+        # clock converter leaves between them; stop early only if the stream
+        # stays idle for STREAM_TIMEOUT_CYCLES.
+        received_data = bytearray()
+        idle_cycles = 0
+        while len(received_data) < count and idle_cycles < self.STREAM_TIMEOUT_CYCLES:
             if (yield self.stream.valid):
                 received_data.append((yield self.stream.payload))
-                yield
+                idle_cycles = 0
             else:
-                # Data ended early.
-                break
-        self.assertEqual(received_data, expected_data)
+                idle_cycles += 1
+            yield
+        return bytes(received_data)
+
+    def expect_data(self, expected_data):
+        # Signal that we are ready to receive data.
+        yield self.stream.ready.eq(1)
+        yield
+
+        # Collect the bytes, then validate that we got all of those we expected.
+        received_data = yield from self.receive_bytes(len(expected_data))
+        if received_data != bytes(expected_data):
+            self.fail("captured data differs from expected:\n" +
+                self.hex_diff(bytes(expected_data), received_data))
 
         if len(expected_data) % 2 == 1:
             # There should then be one padding byte.
-            self.assertEqual((yield self.stream.valid), 1)
-            yield
+            padding = yield from self.receive_bytes(1)
+            self.assertEqual(len(padding), 1)
 
         # There should then be no data left.
         self.assertEqual((yield self.stream.valid), 0)
@@ -631,8 +757,6 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
 
     def instantiate_dut(self):
 
-        from amaranth import DomainRenamer, ResetInserter
-
         self.utmi = Record([
             ('tx_data',     8),
             ('rx_data',     8),
@@ -651,30 +775,16 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         m = Module()
         m.submodules.analyzer = self.analyzer = USBAnalyzer(
             self.utmi, session_valid, speed, speed_changing, next_speed, mem_depth=128)
-        reset_on_start = ResetInserter(self.analyzer.starting)
-        m.submodules.s16to8 = s16to8 = reset_on_start(Stream16to8())
-        m.submodules.clk_conv = clk_conv = StreamFIFO(
-            AsyncFIFOReadReset(width=8, depth=4, r_domain="usb", w_domain="sync"))
-        m.d.comb += [
-            s16to8.input.stream_eq(self.analyzer.stream),
-            clk_conv.input.stream_eq(s16to8.output),
-            clk_conv.fifo.ext_rst.eq(self.analyzer.starting),
-        ]
-        self.stream = clk_conv.output
+        self.attach_output_pipeline(m)
         return m
 
 
     def advance_stream(self, value):
-        yield self.utmi.rx_data.eq(value)
-        yield
+        yield from self.drive_waveform(self.utmi.rx_data, [(value, 1)])
 
 
     @usb_domain_test_case
     def test_single_packet(self):
-        # Enable capture
-        yield self.analyzer.capture_enable.eq(1)
-        yield
-
         # Ensure we're not capturing until a transaction starts.
         self.assertEqual((yield self.analyzer.capturing), 0)
 
@@ -702,25 +812,18 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         yield from self.advance_cycles(5)
         self.assertEqual((yield self.analyzer.capturing), 0)
 
-        # First we should get a start event with a timestamp of zero.
-        start_event = [0xFF, 0x04, 0x00, 0x00]
-
         # Next, we should get a header with the total data length.
         # This should be 0x00, 0x0a; as we captured 10 bytes.
         #
         # Next, we should get a timestamp with the cycle count at which
         # the packet started. This should be zero.
-        packet = [0x00, 0x0a, 0x00, 0x00] + list(range(0, 10))
+        packet = struct.pack(">HH", 10, 0x0000) + bytes(range(0, 10))
 
-        yield from self.expect_data(start_event + packet)
+        yield from self.expect_data(START_EVENT + packet)
 
 
     @usb_domain_test_case
     def test_slow_packet(self):
-        # Enable capture
-        yield self.analyzer.capture_enable.eq(1)
-        yield
-
         # Start a packet.
         yield self.utmi.rx_active.eq(1)
         yield
@@ -739,9 +842,6 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         # Idle for several cycles.
         yield from self.advance_cycles(5)
 
-        # First we should get a start event with a timestamp of zero.
-        start_event = [0xFF, 0x04, 0x00, 0x00]
-
         # First, we should get a header with the total data length.
         # This should be 0x00, 0x0a; as we captured 10 bytes.
         #
@@ -749,17 +849,13 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         # the packet started. This should be zero.
         #
         # Finally, there should be the 10 packet bytes.
-        packet = [0x00, 0x0a, 0x00, 0x00] + list(range(0, 10))
+        packet = struct.pack(">HH", 10, 0x0000) + bytes(range(0, 10))
 
-        yield from self.expect_data(start_event + packet)
+        yield from self.expect_data(START_EVENT + packet)
 
 
     @usb_domain_test_case
     def test_short_packet(self):
-        # Enable capture
-        yield self.analyzer.capture_enable.eq(1)
-        yield
-
         # Apply our first input, and validate that we start capturing.
         yield self.utmi.rx_active.eq(1)
         yield self.utmi.rx_valid.eq(1)
@@ -777,26 +873,107 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         yield from self.advance_cycles(5)
         self.assertEqual((yield self.analyzer.capturing), 0)
 
-        # First we should get a start event with a timestamp of zero.
-        start_event = [0xFF, 0x04, 0x00, 0x00]
-
         # Next, we should get a header with the total data length.
         # This should be 0x00, 0x01; as we captured 1 byte.
         # Then, we should get a timestamp with the cycle count at which
         # the packet started. This should be 0x00, 0x00.
-        packet = [0x00, 0x01, 0x00, 0x00, 0xab]
+        packet = struct.pack(">HH", 1, 0x0000) + b"\xab"
 
-        yield from self.expect_data(start_event + packet)
+        yield from self.expect_data(START_EVENT + packet)
 
 
     @usb_domain_test_case
-    def test_timestamp_wrap(self):
-        # Enable capture.
+    def test_buffer_wraparound(self):
+        # Read back the start event.
+        yield from self.advance_cycles(4)
+        yield from self.expect_data(START_EVENT)
+        yield self.stream.ready.eq(0)
+
+        # Send and read back enough packets to wrap the 128-word buffer.
+        for count in range(5):
+            yield self.utmi.rx_active.eq(1)
+            yield self.utmi.rx_valid.eq(1)
+            yield
+            yield from self.drive_waveform(self.utmi.rx_data,
+                [(count + byte, 1) for byte in range(60)])
+            yield self.utmi.rx_active.eq(0)
+            yield self.utmi.rx_valid.eq(0)
+            yield from self.advance_cycles(5)
+
+            # Each packet is timestamped relative to the previous packet start,
+            # or to the start event for the first packet.
+            timestamp = 0x0a if count == 0 else 0x83
+            packet = struct.pack(">HH", 60, timestamp) + bytes(count + byte for byte in range(60))
+            yield from self.expect_data(packet)
+            yield self.stream.ready.eq(0)
+
+
+    @usb_domain_test_case
+    def test_ingress_fifo_keeps_last(self):
+        # Send a packet and read it all back.
+        yield self.utmi.rx_active.eq(1)
+        yield self.utmi.rx_valid.eq(1)
+        yield
+        yield from self.drive_waveform(self.utmi.rx_data, [(byte, 1) for byte in range(20)])
+        yield self.utmi.rx_active.eq(0)
+        yield self.utmi.rx_valid.eq(0)
+        yield from self.advance_cycles(5)
+
+        packet = struct.pack(">HH", 20, 0x0000) + bytes(range(20))
+        yield from self.expect_data(START_EVENT + packet)
+
+        # Every word the analyzer flagged as `last` left the FIFO still flagged.
+        last_words_in = yield self.last_words_in
+        self.assertGreater(last_words_in, 0)
+        self.assertEqual((yield self.last_words_out), last_words_in)
+
+
+    @usb_domain_test_case
+    def test_restart_discards_stale_data(self):
+        # Capture a packet longer than the clock converter can hold, without
+        # reading any of it, and let the rest of it back up into the ingress
+        # FIFO.
+        yield self.utmi.rx_active.eq(1)
+        yield self.utmi.rx_valid.eq(1)
+        yield
+        yield from self.drive_waveform(self.utmi.rx_data, [(byte, 1) for byte in range(60)])
+        yield self.utmi.rx_active.eq(0)
+        yield self.utmi.rx_valid.eq(0)
+        yield from self.advance_cycles(40)
+        self.assertGreater((yield self.ingress_fifo.level), 0)
+
+        # Stop capture, and wait for the analyzer to finish stopping.
+        yield self.analyzer.capture_enable.eq(0)
+        for _ in range(self.STREAM_TIMEOUT_CYCLES):
+            if (yield self.analyzer.stopped):
+                break
+            yield
+        self.assertEqual((yield self.analyzer.stopped), 1)
+
+        # Restarting capture empties the ingress FIFO, and discards everything
+        # else queued from the last run; only the new start event comes out.
         yield self.analyzer.capture_enable.eq(1)
         yield
+        self.assertEqual((yield self.analyzer.starting), 1)
+        yield
+        self.assertEqual((yield self.ingress_fifo.level), 0)
+        yield from self.advance_cycles(4)
+        yield from self.expect_data(START_EVENT)
 
-        # Nothing happens for 0x10123 cycles.
-        yield from self.advance_cycles(0x10123)
+
+    @usb_domain_test_case
+    def test_timestamp_wrap(self):
+        # Nothing happens for 0x10123 cycles. Rather than simulating all of
+        # them, jump the timestamp counter forward to just short of its wrap
+        # and only run the last few hundred cycles. The load itself takes the
+        # place of one counted cycle.
+        skipped_cycles = 0xFFF0
+        timestamp = yield self.analyzer.current_time
+        yield self.analyzer.current_time_load_value.eq(timestamp + skipped_cycles + 1)
+        yield self.analyzer.current_time_load.eq(1)
+        yield
+        yield self.analyzer.current_time_load.eq(0)
+        yield from self.advance_cycles(0x10123 - skipped_cycles - 1)
 
         # Then there's a one-byte packet.
         yield self.utmi.rx_active.eq(1)
@@ -807,25 +984,16 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         yield self.utmi.rx_active.eq(0)
         yield from self.advance_stream(10)
 
-        # First we should get a start event with a timestamp of zero.
-        start_event = [0xFF, 0x04, 0x00, 0x00]
-
-        # Then, we should get an event with code zero, timestamp 0xFFFF.
-        rollover_event = [0xFF, 0x00, 0xFF, 0xFF]
+        # After the start event, we should get an event with code zero and
+        # timestamp 0xFFFF; then the packet, with length 1 and timestamp 0x0123.
+        packet = struct.pack(">HH", 1, 0x0123) + b"\xab"
 
-        # Next we should get the packet, with length 1 and timestamp 0x0123.
-        packet = [0x00, 0x01, 0x01, 0x23, 0xAB]
-
-        yield from self.expect_data(start_event + rollover_event + packet)
+        yield from self.expect_data(START_EVENT + ROLLOVER_EVENT + packet)
 
 
     @usb_domain_test_case
     def test_stop_event(self):
 
-        # Start capture.
-        yield self.analyzer.capture_enable.eq(1)
-        yield
-
         # Nothing happens for 0x123 cycles.
         yield from self.advance_cycles(0x123)
 
@@ -833,94 +1001,132 @@ class USBAnalyzerTest(USBAnalyzerTestBase):
         yield self.analyzer.capture_enable.eq(0)
         yield
 
-        # First we should get a start event with a timestamp of zero.
-        start_event = [0xFF, 0x04, 0x00, 0x00]
-
         # Then, we should get an stop event with a timestamp of 0x123.
-        stop_event = [0xFF, 0x01, 0x01, 0x23]
+        stop_event = STOP_EVENT_PREFIX + struct.pack(">H", 0x0123)
 
         # Validate that we get all of the expected bytes.
-        yield from self.expect_data(start_event + stop_event)
+        yield from self.expect_data(START_EVENT + stop_event)
 
 
     @usb_domain_test_case
-    def test_trigger_single_stage_match(self):
-        # Configure one trigger stage:
-        # Match bytes [AA BB CC] starting at packet offset 1.
-        yield self.analyzer.trigger.enable.eq(1)
-        yield self.analyzer.trigger.armed.eq(1)
-        yield self.analyzer.trigger.output_enable.eq(1)
-        yield self.analyzer.trigger.stage_count.eq(1)
-        yield self.analyzer.trigger.stage_offsets[0].eq(1)
-        yield self.analyzer.trigger.stage_lengths[0].eq(3)
-        for i, value in enumerate((0xAA, 0xBB, 0xCC)):
-            yield self.analyzer.trigger.pattern_write_addr.eq(i)
-            yield self.analyzer.trigger.pattern_write_data.eq(value)
-            yield self.analyzer.trigger.pattern_write_en.eq(1)
-            yield
-        yield self.analyzer.trigger.pattern_write_en.eq(0)
-        yield
-
-        # Start capture and send a matching packet.
-        yield self.analyzer.capture_enable.eq(1)
-        yield
+    def test_overrun(self):
+        # Send a packet larger than the 128-word buffer, without reading.
         yield self.utmi.rx_active.eq(1)
         yield self.utmi.rx_valid.eq(1)
-        yield self.utmi.rx_data.eq(0x10)
-        yield
         yield
-        yield from self.advance_stream(0xAA)
-        yield from self.advance_stream(0xBB)
-        yield from self.advance_stream(0xCC)
+        yield from self.drive_waveform(self.utmi.rx_data,
+            [(byte & 0xFF, 1) for byte in range(300)])
         yield self.utmi.rx_active.eq(0)
         yield self.utmi.rx_valid.eq(0)
+        yield from self.advance_cycles(5)
+
+        # The analyzer should report the overrun until capture is stopped.
+        self.assertEqual((yield self.analyzer.overrun), 1)
+        self.assertEqual((yield self.analyzer.capturing), 0)
+        self.assertEqual((yield self.analyzer.stopped), 0)
+        yield self.analyzer.capture_enable.eq(0)
+        yield from self.advance_cycles(2)
+        self.assertEqual((yield self.analyzer.overrun), 0)
+        self.assertEqual((yield self.analyzer.stopped), 1)
+
+        # Capture can then be restarted.
+        yield self.analyzer.capture_enable.eq(1)
         yield
-        yield from self.advance_cycles(3)
+        self.assertEqual((yield self.analyzer.starting), 1)
+
 
-        # Trigger should have fired exactly once and pulsed output high.
-        self.assertEqual((yield self.analyzer.trigger_output), 1)
-        self.assertEqual((yield self.analyzer.trigger_fire_count), 1)
-        yield from self.advance_cycles(TRIGGER_OUTPUT_PULSE_CYCLES + 1)
-        self.assertEqual((yield self.analyzer.trigger_output), 0)
+    def program_trigger_stage(self, stage, offset, pattern):
+        trigger = self.analyzer.trigger
+
+        # Write the stage's offset and length in one go.
+        yield trigger.stage_write_addr.eq(stage)
+        yield trigger.stage_write_data.eq((len(pattern) << 16) | offset)
+        yield trigger.stage_write_en.eq(0b111)
+        yield
+        yield trigger.stage_write_en.eq(0)
+
+        # Burst the pattern bytes, holding the write enable across the run.
+        base = stage * trigger.max_pattern
+        yield trigger.pattern_write_en.eq(1)
+        for i, value in enumerate(pattern):
+            yield trigger.pattern_write_addr.eq(base + i)
+            yield trigger.pattern_write_data.eq(value)
+            yield
+        yield trigger.pattern_write_en.eq(0)
+        yield
 
 
     @usb_domain_test_case
-    def test_trigger_single_stage_mismatch(self):
+    def test_trigger_single_stage(self):
         # Configure one trigger stage:
         # Match bytes [AA BB CC] starting at packet offset 1.
         yield self.analyzer.trigger.enable.eq(1)
         yield self.analyzer.trigger.armed.eq(1)
         yield self.analyzer.trigger.output_enable.eq(1)
         yield self.analyzer.trigger.stage_count.eq(1)
-        yield self.analyzer.trigger.stage_offsets[0].eq(1)
-        yield self.analyzer.trigger.stage_lengths[0].eq(3)
-        for i, value in enumerate((0xAA, 0xBB, 0xCC)):
-            yield self.analyzer.trigger.pattern_write_addr.eq(i)
-            yield self.analyzer.trigger.pattern_write_data.eq(value)
-            yield self.analyzer.trigger.pattern_write_en.eq(1)
-            yield
-        yield self.analyzer.trigger.pattern_write_en.eq(0)
-        yield
+        yield from self.program_trigger_stage(0, 1, TRIGGER_TEST_PATTERN)
 
-        # Start capture and send a non-matching packet.
-        yield self.analyzer.capture_enable.eq(1)
-        yield
-        yield self.utmi.rx_active.eq(1)
-        yield self.utmi.rx_valid.eq(1)
-        yield self.utmi.rx_data.eq(0x10)
-        yield
-        yield
-        yield from self.advance_stream(0xAA)
-        yield from self.advance_stream(0x99)  # mismatch at second compared byte
-        yield from self.advance_stream(0xCC)
-        yield self.utmi.rx_active.eq(0)
-        yield self.utmi.rx_valid.eq(0)
-        yield
-        yield from self.advance_cycles(3)
+        # Send each packet in turn.
+        for name, payload, should_fire in TRIGGER_TEST_CASES:
+            with self.subTest(name):
+                fire_count = yield self.analyzer.trigger_fire_count
+
+                yield self.utmi.rx_active.eq(1)
+                yield self.utmi.rx_valid.eq(1)
+                yield self.utmi.rx_data.eq(0x10)
+                yield
+                yield
+                yield from self.drive_waveform(self.utmi.rx_data, [(byte, 1) for byte in payload])
+                yield self.utmi.rx_active.eq(0)
+                yield self.utmi.rx_valid.eq(0)
+                yield
+
+                # The stage decision is registered as the packet ends, so one
+                # more edge brings out the fire count and output pulse.
+                yield
+
+                # A match fires the trigger exactly once and pulses the output high.
+                output = yield self.analyzer.trigger_output
+                count  = yield self.analyzer.trigger_fire_count
+                self.assertEqual((output, count), (int(should_fire), fire_count + should_fire))
+                yield from self.advance_cycles(TRIGGER_OUTPUT_PULSE_CYCLES + 1)
+                self.assertEqual((yield self.analyzer.trigger_output), 0)
 
-        # Trigger should not fire.
-        self.assertEqual((yield self.analyzer.trigger_output), 0)
-        self.assertEqual((yield self.analyzer.trigger_fire_count), 0)
+
+class FakeUTMITranslator(Elaboratable):
+    """ Minimal stand-in for luna's UTMITranslator, for simulation only.
+
+    Reproduces the translator's receive path -- RxActive from DIR and NXT, and
+    RxData / RxValid with a one-cycle delay -- without the register access and
+    RxCmd machinery, none of which the analyzer uses.
+    """
+
+    def __init__(self, *, ulpi):
+        self.ulpi = ulpi
+
+        self.rx_data   = Signal(8)
+        self.rx_valid  = Signal()
+        self.rx_active = Signal()
+
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # A receive starts when DIR rises with NXT, and stops when DIR drops.
+        past_dir = Signal()
+        m.d.usb += past_dir.eq(self.ulpi.dir_i)
+
+        with m.If(~self.ulpi.dir_i):
+            m.d.usb += self.rx_active.eq(0)
+        with m.Elif(~past_dir & self.ulpi.nxt_i):
+            m.d.usb += self.rx_active.eq(1)
+
+        m.d.usb += [
+            self.rx_data   .eq(self.ulpi.data_i),
+            self.rx_valid  .eq(self.ulpi.nxt_i & self.rx_active)
+        ]
+
+        return m
 
 
 class USBAnalyzerStackTest(USBAnalyzerTestBase):
@@ -928,92 +1134,59 @@ class USBAnalyzerStackTest(USBAnalyzerTestBase):
 
     def instantiate_dut(self):
 
-        from luna.gateware.interface.ulpi import UTMITranslator
-        from amaranth import DomainRenamer, ResetInserter
-
-        self.ulpi = Record([
-            ('data', [
-                ('i',  8),
-                ('o',  8),
-                ('oe', 8),
-            ]),
-            ('nxt', [('i', 1)]),
-            ('stp', [('o', 1)]),
-            ('dir', [('i', 1)]),
-            ('clk', [('o', 1)]),
-            ('rst', [('o', 1)]),
-        ])
+        # Only the PHY-driven lines matter to the receive-only translator.
+        self.ulpi = SimpleNamespace(
+            data_i = Signal(8, name="ulpi_data_i"),
+            nxt_i  = Signal(name="ulpi_nxt_i"),
+            dir_i  = Signal(name="ulpi_dir_i"),
+        )
 
         session_valid = True
         speed = C(0x00, 2)
         speed_changing = False
         next_speed = speed
 
-        # Create a stack of our UTMITranslator and our USBAnalyzer.
+        # Create a stack of a receive-only UTMI translator and our USBAnalyzer.
         # We'll wrap the both in a module to establish a synthetic hierarchy.
         m = Module()
-        m.submodules.translator = self.translator = UTMITranslator(ulpi=self.ulpi, handle_clocking=False)
+        m.submodules.translator = self.translator = FakeUTMITranslator(ulpi=self.ulpi)
         m.submodules.analyzer   = self.analyzer = USBAnalyzer(
             self.translator, session_valid, speed, speed_changing, next_speed, mem_depth=128)
-        reset_on_start = ResetInserter(self.analyzer.starting)
-        m.submodules.s16to8 = s16to8 = reset_on_start(Stream16to8())
-        m.submodules.clk_conv = clk_conv = StreamFIFO(
-            AsyncFIFOReadReset(width=8, depth=4, r_domain="usb", w_domain="sync"))
-        m.d.comb += [
-            s16to8.input.stream_eq(self.analyzer.stream),
-            clk_conv.input.stream_eq(s16to8.output),
-            clk_conv.fifo.ext_rst.eq(self.analyzer.starting),
-        ]
-        self.stream = clk_conv.output
+        self.attach_output_pipeline(m)
         return m
 
 
-    def initialize_signals(self):
-
-        # Ensure the translator doesn't need to perform any register reads/writes
-        # by default, so we can focus on packet Rx.
-        yield self.translator.xcvr_select.eq(1)
-        yield self.translator.dm_pulldown.eq(1)
-        yield self.translator.dp_pulldown.eq(1)
-        yield self.translator.use_external_vbus_indicator.eq(0)
-
-
     @usb_domain_test_case
     def test_simple_analysis(self):
-        # Enable capture
-        yield self.analyzer.capture_enable.eq(1)
-        yield from self.advance_cycles(10)
+        # Let capture run for a while before the packet.
+        yield from self.advance_cycles(9)
 
         # Start a new packet.
-        yield self.ulpi.dir.i.eq(1)
-        yield self.ulpi.nxt.i.eq(1)
-
-        # Bus turnaround packet.
-        yield self.ulpi.data.i.eq(0x80)
-        yield
-
-        # Provide some data to be captured.
-        for i in [0x2d, 0x00, 0x10]:
-            yield self.ulpi.data.i.eq(i)
-            yield
+        yield self.ulpi.dir_i.eq(1)
+        yield self.ulpi.nxt_i.eq(1)
+
+        # Bus turnaround packet, then some data to be captured.
+        yield from self.drive_waveform(self.ulpi.data_i, [
+            (0x80, 1),
+            (0x2d, 1),
+            (0x00, 1),
+            (0x10, 1),
+        ])
 
         # Mark our packet as complete.
-        yield self.ulpi.dir.i.eq(0)
-        yield self.ulpi.nxt.i.eq(0)
+        yield self.ulpi.dir_i.eq(0)
+        yield self.ulpi.nxt_i.eq(0)
         yield
 
         # Wait for a few cycles, for realism.
         yield from self.advance_cycles(10)
 
-        # First we should get a start event with a timestamp of zero.
-        start_event = [0xFF, 0x04, 0x00, 0x00]
-
         # Validate that we got the correct packet out; plus headers.
         # We waited 10 cycles before starting the packet, so the
         # timestamp should be 0x00, 0x0a.
-        packet = [0x00, 0x03, 0x00, 0x0a, 0x2d, 0x00, 0x10]
+        packet = struct.pack(">HH", 3, 0x000a) + b"\x2d\x00\x10"
 
-        yield from self.expect_data(start_event + packet)
+        yield from self.expect_data(START_EVENT + packet)
 
 
 if __name__ == "__main__":
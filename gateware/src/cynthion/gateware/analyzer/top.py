@@ -8,10 +8,15 @@
 
 """ Generic USB analyzer backend generator for LUNA. """
 
+import unittest
+
 from enum import IntEnum, IntFlag
+from functools import lru_cache
+from types import SimpleNamespace
 
-from amaranth                            import Signal, Elaboratable, Module, ResetInserter, C, Mux, Array, Cat
+from amaranth                            import Signal, Elaboratable, Module, ResetInserter, DomainRenamer, C, Mux, Array, Cat, Memory
 from amaranth.build.res                  import ResourceError
+from amaranth.lib.fifo                   import SyncFIFOBuffered
 from usb_protocol.emitters               import DeviceDescriptorCollection
 from usb_protocol.types                  import USBRequestType, USBRequestRecipient
 
@@ -26,6 +31,7 @@ from luna.gateware.architecture.flash_sn import ECP5FlashUIDStringDescriptor
 from luna.gateware.interface.ulpi        import UTMITranslator
 from luna.gateware.usb.usb2              import USBSpeed
 from luna.gateware.usb.usb2.control      import USBControlEndpoint
+from luna.gateware.test                  import LunaGatewareTestCase, usb_domain_test_case
 from luna.gateware.usb.request.standard  import StandardRequestHandler
 from luna.gateware.usb.request.windows   import MicrosoftOS10DescriptorCollection, MicrosoftOS10RequestHandler
 
@@ -53,7 +59,7 @@ MAX_BULK_PACKET_SIZE  = 512
 
 # Minor version of the protocol supported by the analyzer.
 # The major version is specified in bInterfaceProtocol.
-MINOR_VERSION = 2
+MINOR_VERSION = 3
 
 TRIGGER_MAX_STAGES = 8
 TRIGGER_MAX_PATTERN_BYTES = 32
@@ -61,11 +67,44 @@ TRIGGER_CONTROL_PAYLOAD_LEN = 2
 TRIGGER_STAGE_PAYLOAD_LEN = 4 + TRIGGER_MAX_PATTERN_BYTES + TRIGGER_MAX_PATTERN_BYTES
 TRIGGER_CAPS_PAYLOAD_LEN = 4
 TRIGGER_STATUS_PAYLOAD_LEN = 5
+OVERRUN_COUNT_PAYLOAD_LEN = 8
+
+# Longest reply sent from the GET_SIMPLE_DATA state.
+SIMPLE_DATA_MAX_LEN = max(TRIGGER_STATUS_PAYLOAD_LEN, OVERRUN_COUNT_PAYLOAD_LEN)
+
+# WinUSB device interface GUID advertised for the analyzer interface.
+ANALYZER_INTERFACE_GUID = "{88bae032-5a81-49f0-bc3d-a4ff138216d6}"
+
+# Microsoft OS 1.0 string descriptor, advertising our OS descriptor request code.
+MSFT_VENDOR_CODE = 0xee
+MSFT_OS_STRING_DESCRIPTOR = get_string_descriptor("MSFT100" + chr(MSFT_VENDOR_CODE))
 
 # Capture sync square wave on PMOD A2 and LED0: toggle every 30 seconds at 60 MHz (1 cycle per minute).
 CAPTURE_SYNC_TOGGLE_CYCLES = 1_800_000_000
 
 
+@lru_cache(maxsize=None)
+def _build_msft_descriptors(interface_count, interface_guid=None):
+    """ Build the Microsoft OS 1.0 descriptors binding WinUSB to each interface.
+
+    The collection depends only on its arguments, so it is built once and
+    shared by every elaboration that asks for the same set.
+    """
+    msft_descriptors = MicrosoftOS10DescriptorCollection()
+    with msft_descriptors.ExtendedCompatIDDescriptor() as c:
+        for interface_number in range(interface_count):
+            with c.Function() as f:
+                f.bFirstInterfaceNumber = interface_number
+                f.compatibleID          = 'WINUSB'
+    if interface_guid is not None:
+        with msft_descriptors.ExtendedPropertiesDescriptor() as d:
+            with d.Property() as p:
+                p.dwPropertyDataType = RegistryTypes.REG_SZ
+                p.PropertyName       = "DeviceInterfaceGUID"
+                p.PropertyData       = interface_guid
+    return msft_descriptors
+
+
 class USBAnalyzerTriggerConfig:
     """Container for trigger configuration and runtime status signals."""
 
@@ -80,36 +119,24 @@ class USBAnalyzerTriggerConfig:
         self.output_enable = Signal(reset=1)
         self.stage_count = Signal(range(max_stages + 1), reset=0)
 
-        self.stage_offsets = Array(
-            Signal(16, name=f"trigger_stage_{i}_offset")
-            for i in range(max_stages)
-        )
-        self.stage_lengths = Array(
-            Signal(8, name=f"trigger_stage_{i}_length")
-            for i in range(max_stages)
-        )
-
-        pattern_flat = []
-        mask_flat = []
-        for stage in range(max_stages):
-            for index in range(max_pattern):
-                pattern_flat.append(
-                    Signal(8, name=f"trigger_stage_{stage}_byte_{index}")
-                )
-                mask_flat.append(
-                    Signal(8, reset=0xFF, name=f"trigger_stage_{stage}_mask_{index}")
-                )
-        self.patterns_flat = Array(pattern_flat)
-        self.masks_flat = Array(mask_flat)
-
-        # BRAM-backed pattern/mask writes for the analyzer datapath.
+        # Stage and pattern/mask tables, shared by the analyzer datapath and
+        # GET_TRIGGER_STAGE readback. Stage words hold a 16-bit offset and an
+        # 8-bit length; pattern words hold a pattern byte in the low lane and
+        # its mask byte in the high lane.
         flat_depth = max_stages * max_pattern
+        self.stage_memory = Memory(width=24, depth=max_stages,
+            init=[0] * max_stages, name="trigger_stages")
+        self.pattern_memory = Memory(width=16, depth=flat_depth,
+            init=[0xFF00] * flat_depth, name="trigger_patterns")
         self.pattern_write_en = Signal()
         self.pattern_write_addr = Signal(range(flat_depth))
         self.pattern_write_data = Signal(8)
         self.mask_write_en = Signal()
         self.mask_write_addr = Signal(range(flat_depth))
         self.mask_write_data = Signal(8)
+        self.stage_write_en = Signal(3)
+        self.stage_write_addr = Signal(range(max_stages))
+        self.stage_write_data = Signal(24)
 
         # Host control strobes.
         self.arm_strobe = Signal()
@@ -134,6 +161,126 @@ class USBAnalyzerRegister(Elaboratable):
         return m
 
 
+class USBAnalyzerTriggerStageReader(Elaboratable):
+    """ Streams one trigger stage's configuration out of the trigger tables.
+
+    Produces the GET_TRIGGER_STAGE payload -- offset, length, a reserved byte,
+    then the pattern bytes and the mask bytes -- reading each byte from the
+    stage and pattern memories as it is sent, rather than muxing it out of a
+    register copy of every stage.
+
+    I/O port:
+        I: start        -- Strobe that starts the stream.
+        I: stage_index  -- The stage to be read out.
+        *: stream       -- The generated stream interface.
+    """
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+
+        self.start       = Signal()
+        self.stage_index = Signal(range(trigger.max_stages))
+        self.stream      = USBInStreamInterface()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.stage_read_port = stage_read_port = \
+            self.trigger.stage_memory.read_port(domain="usb", transparent=False)
+        m.submodules.pattern_read_port = pattern_read_port = \
+            self.trigger.pattern_memory.read_port(domain="usb", transparent=False)
+
+        position = Signal(range(TRIGGER_STAGE_PAYLOAD_LEN))
+        on_last  = position == (TRIGGER_STAGE_PAYLOAD_LEN - 1)
+        advance  = self.stream.valid & self.stream.ready & ~on_last
+
+        # The read ports are addressed with the position the stream will hold
+        # on the next cycle, so that its byte is on their outputs by then.
+        # Pattern and mask bytes share an index within their halves.
+        next_position = Mux(advance, position + 1, position)
+        byte_index    = Signal(self.trigger.pattern_bits)
+        m.d.comb += [
+            byte_index              .eq(next_position - 4),
+            stage_read_port.addr    .eq(self.stage_index),
+            pattern_read_port.addr  .eq(Cat(byte_index, self.stage_index)),
+        ]
+
+        stage_bytes = Array([
+            stage_read_port.data[0:8],
+            stage_read_port.data[8:16],
+            stage_read_port.data[16:24],
+            C(0, 8),
+        ])
+        m.d.comb += [
+            self.stream.first    .eq((position == 0) & self.stream.valid),
+            self.stream.last     .eq(on_last & self.stream.valid),
+            self.stream.payload  .eq(
+                Mux(position < 4, stage_bytes[position[0:2]],
+                Mux(position < 4 + self.trigger.max_pattern,
+                    pattern_read_port.data[0:8],
+                    pattern_read_port.data[8:16]))
+            ),
+        ]
+
+        with m.FSM(domain="usb") as fsm:
+            m.d.comb += self.stream.valid.eq(fsm.ongoing('STREAMING'))
+
+            # IDLE -- hold at the start of the payload until asked to send.
+            with m.State('IDLE'):
+                m.d.usb += position.eq(0)
+                with m.If(self.start):
+                    m.next = 'STREAMING'
+
+            # STREAMING -- send each byte as it's accepted.
+            with m.State('STREAMING'):
+                with m.If(advance):
+                    m.d.usb += position.eq(position + 1)
+                with m.If(self.stream.ready & on_last):
+                    m.next = 'IDLE'
+
+        return m
+
+
+class USBAnalyzerOverrunCounters(Elaboratable):
+    """ Counts the capture pipeline's overruns and stalls for the host.
+
+    Both counts saturate rather than wrapping. The overrun count covers every
+    capture since power-up; the stall count restarts with each capture, so
+    hosts can compare it against a capture's traffic to size the buffering.
+
+    I/O port:
+        I: overrun        -- The analyzer's latched overrun flag. (usb)
+        I: starting       -- Strobe marking the start of a capture. (usb)
+        I: stalled        -- Asserted on cycles the pipeline holds off the
+                             analyzer's output. (sync)
+        O: overrun_count  -- Number of captures that lost data. (usb)
+        O: stall_count    -- Number of stalled cycles this capture. (sync)
+    """
+
+    def __init__(self):
+        self.overrun       = Signal()
+        self.starting      = Signal()
+        self.stalled       = Signal()
+        self.overrun_count = Signal(32)
+        self.stall_count   = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Each rising edge of the latched overrun flag is one overrun.
+        overrun_last = Signal()
+        m.d.usb += overrun_last.eq(self.overrun)
+        with m.If(self.overrun & ~overrun_last & ~self.overrun_count.all()):
+            m.d.usb += self.overrun_count.eq(self.overrun_count + 1)
+
+        with m.If(self.starting):
+            m.d.sync += self.stall_count.eq(0)
+        with m.Elif(self.stalled & ~self.stall_count.all()):
+            m.d.sync += self.stall_count.eq(self.stall_count + 1)
+
+        return m
+
+
 class USBAnalyzerVendorRequests(IntEnum):
     GET_STATE = 0
     SET_STATE = 1
@@ -147,6 +294,7 @@ class USBAnalyzerVendorRequests(IntEnum):
     ARM_TRIGGER = 10
     DISARM_TRIGGER = 11
     GET_TRIGGER_STAGE = 12
+    GET_OVERRUN_COUNT = 13
 
 
 # Bit numbers of state register bits.
@@ -183,12 +331,24 @@ class USBAnalyzerSupportedSpeeds(IntFlag):
     USB_SPEED_HIGH = 0b1000
 
 
+# Speeds that can be captured on every board revision.
+SUPPORTED_SPEEDS_BASE = \
+    USBAnalyzerSupportedSpeeds.USB_SPEED_LOW | \
+    USBAnalyzerSupportedSpeeds.USB_SPEED_FULL | \
+    USBAnalyzerSupportedSpeeds.USB_SPEED_HIGH
+
+
 class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
 
     def __init__(self, state, test_config, trigger):
         self.state = state
         self.test_config = test_config
         self.trigger = trigger
+
+        # Pipeline counts reported by GET_OVERRUN_COUNT; see
+        # USBAnalyzerOverrunCounters.
+        self.overrun_count = Signal(32)
+        self.stall_count = Signal(32)
         super().__init__()
 
     def elaborate(self, platform):
@@ -203,12 +363,35 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
         valid_stage_index = Signal()
         rx_count = Signal(range(TRIGGER_STAGE_PAYLOAD_LEN + 1))
         control_flags = Signal(8)
+        arm_request = Signal()
         control_stage_count = Signal(8)
+        stage_length_clamped = Mux(
+            interface.rx.payload > self.trigger.max_pattern,
+            self.trigger.max_pattern,
+            interface.rx.payload,
+        )
+
+        # SET_TRIGGER_STAGE payload bytes 4 onward are the pattern bytes, then
+        # the mask bytes; both halves share an index within the stage.
+        pattern_base = 4
+        mask_base = pattern_base + self.trigger.max_pattern
+        rx_is_pattern = Signal()
+        rx_is_mask = Signal()
+        rx_byte_index = Signal(self.trigger.pattern_bits)
+        rx_flat_index = Signal(self.trigger.pattern_bits + self.trigger.stage_bits)
+        m.d.comb += [
+            rx_is_pattern.eq((rx_count >= pattern_base) & (rx_count < mask_base)),
+            rx_is_mask.eq((rx_count >= mask_base) & (rx_count < mask_base + self.trigger.max_pattern)),
+            rx_byte_index.eq(rx_count - pattern_base),
+            rx_flat_index.eq(Cat(rx_byte_index, stage_index)),
+        ]
 
         status_flags = Signal(8)
         status_sequence_stage = Signal(8)
         status_stage_count = Signal(8)
-        m.d.comb += status_flags.eq(Cat(
+        # The flags byte is registered, keeping the trigger logic out of the
+        # transmitter's data path; reads see it one cycle late.
+        m.d.usb += status_flags.eq(Cat(
             self.trigger.enable,
             self.trigger.armed,
             self.trigger.output_enable,
@@ -225,29 +408,84 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
             self.trigger.arm_strobe.eq(0),
             self.trigger.disarm_strobe.eq(0),
             self.trigger.pattern_write_en.eq(0),
-            self.trigger.pattern_write_addr.eq(0),
-            self.trigger.pattern_write_data.eq(0),
+            self.trigger.pattern_write_addr.eq(rx_flat_index),
+            self.trigger.pattern_write_data.eq(interface.rx.payload),
             self.trigger.mask_write_en.eq(0),
-            self.trigger.mask_write_addr.eq(0),
-            self.trigger.mask_write_data.eq(0),
+            self.trigger.mask_write_addr.eq(rx_flat_index),
+            self.trigger.mask_write_data.eq(interface.rx.payload),
+            self.trigger.stage_write_en.eq(0),
+            self.trigger.stage_write_addr.eq(stage_index),
+            self.trigger.stage_write_data.eq(Cat(
+                interface.rx.payload,
+                interface.rx.payload,
+                stage_length_clamped,
+            )),
             stage_index.eq(stage_index_raw[0:self.trigger.stage_bits]),
             valid_stage_index.eq(stage_index_raw < self.trigger.max_stages),
         ]
 
-        # Small transmitter for common 1-5 byte replies.
+        # Small transmitter for common 1-8 byte replies.
         m.submodules.simple_transmitter = simple_transmitter = StreamSerializer(
-            data_length=TRIGGER_STATUS_PAYLOAD_LEN,
+            data_length=SIMPLE_DATA_MAX_LEN,
             domain="usb",
             stream_type=USBInStreamInterface,
-            max_length_width=3,
+            max_length_width=4,
         )
         # Stage transmitter is only used for full stage readback.
-        m.submodules.stage_transmitter = stage_transmitter = StreamSerializer(
-            data_length=TRIGGER_STAGE_PAYLOAD_LEN,
-            domain="usb",
-            stream_type=USBInStreamInterface,
-            max_length_width=7,
-        )
+        m.submodules.stage_transmitter = stage_transmitter = \
+            USBAnalyzerTriggerStageReader(self.trigger)
+        m.d.comb += stage_transmitter.stage_index.eq(stage_index)
+
+        # Select the reply for the short read-only requests, all of which
+        # are answered by the GET_SIMPLE_DATA state.
+        supported_speeds = SUPPORTED_SPEEDS_BASE
+
+        # Automatic speed detection is only supported on Cynthion r0.6+.
+        if platform.version >= (0, 6):
+            supported_speeds |= USBAnalyzerSupportedSpeeds.USB_SPEED_AUTO
+
+        simple_payload = Signal(SIMPLE_DATA_MAX_LEN * 8)
+        simple_length = Signal(range(SIMPLE_DATA_MAX_LEN + 1))
+        with m.Switch(setup.request):
+            with m.Case(USBAnalyzerVendorRequests.GET_STATE):
+                m.d.comb += [
+                    simple_payload.eq(self.state.current),
+                    simple_length.eq(1),
+                ]
+            with m.Case(USBAnalyzerVendorRequests.GET_SPEEDS):
+                m.d.comb += [
+                    simple_payload.eq(supported_speeds),
+                    simple_length.eq(1),
+                ]
+            with m.Case(USBAnalyzerVendorRequests.GET_MINOR_VERSION):
+                m.d.comb += [
+                    simple_payload.eq(MINOR_VERSION),
+                    simple_length.eq(1),
+                ]
+            with m.Case(USBAnalyzerVendorRequests.GET_TRIGGER_CAPS):
+                m.d.comb += [
+                    simple_payload.eq(
+                        self.trigger.max_stages |
+                        (self.trigger.max_pattern << 8) |
+                        ((TRIGGER_STAGE_PAYLOAD_LEN & 0xFFFF) << 16)),
+                    simple_length.eq(TRIGGER_CAPS_PAYLOAD_LEN),
+                ]
+            with m.Case(USBAnalyzerVendorRequests.GET_TRIGGER_STATUS):
+                m.d.comb += [
+                    simple_payload.eq(Cat(
+                        status_flags,
+                        status_sequence_stage,
+                        self.trigger.fire_count[0:8],
+                        self.trigger.fire_count[8:16],
+                        status_stage_count,
+                    )),
+                    simple_length.eq(TRIGGER_STATUS_PAYLOAD_LEN),
+                ]
+            with m.Case(USBAnalyzerVendorRequests.GET_OVERRUN_COUNT):
+                m.d.comb += [
+                    simple_payload.eq(Cat(self.overrun_count, self.stall_count)),
+                    simple_length.eq(OVERRUN_COUNT_PAYLOAD_LEN),
+                ]
 
         # Handle vendor requests to our interface.
         with m.If(
@@ -255,19 +493,11 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
                 (setup.recipient == USBRequestRecipient.INTERFACE) &
                 (setup.index == 0)):
 
+            # Claim every request up to GET_OVERRUN_COUNT, except the
+            # unassigned request number 8.
             m.d.comb += interface.claim.eq(
-                (setup.request == USBAnalyzerVendorRequests.GET_STATE) |
-                (setup.request == USBAnalyzerVendorRequests.SET_STATE) |
-                (setup.request == USBAnalyzerVendorRequests.GET_SPEEDS)|
-                (setup.request == USBAnalyzerVendorRequests.SET_TEST_CONFIG) |
-                (setup.request == USBAnalyzerVendorRequests.GET_MINOR_VERSION) |
-                (setup.request == USBAnalyzerVendorRequests.GET_TRIGGER_CAPS) |
-                (setup.request == USBAnalyzerVendorRequests.SET_TRIGGER_CONTROL) |
-                (setup.request == USBAnalyzerVendorRequests.SET_TRIGGER_STAGE) |
-                (setup.request == USBAnalyzerVendorRequests.GET_TRIGGER_STATUS) |
-                (setup.request == USBAnalyzerVendorRequests.ARM_TRIGGER) |
-                (setup.request == USBAnalyzerVendorRequests.DISARM_TRIGGER) |
-                (setup.request == USBAnalyzerVendorRequests.GET_TRIGGER_STAGE))
+                (setup.request <= USBAnalyzerVendorRequests.GET_OVERRUN_COUNT) &
+                (setup.request != 8))
 
             with m.FSM(domain="usb"):
 
@@ -280,18 +510,18 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
                         # Select which vendor we're going to handle.
                         with m.Switch(setup.request):
 
-                            with m.Case(USBAnalyzerVendorRequests.GET_STATE):
-                                m.next = 'GET_STATE'
+                            with m.Case(
+                                    USBAnalyzerVendorRequests.GET_STATE,
+                                    USBAnalyzerVendorRequests.GET_SPEEDS,
+                                    USBAnalyzerVendorRequests.GET_MINOR_VERSION,
+                                    USBAnalyzerVendorRequests.GET_TRIGGER_CAPS,
+                                    USBAnalyzerVendorRequests.GET_TRIGGER_STATUS,
+                                    USBAnalyzerVendorRequests.GET_OVERRUN_COUNT):
+                                m.next = 'GET_SIMPLE_DATA'
                             with m.Case(USBAnalyzerVendorRequests.SET_STATE):
                                 m.next = 'SET_STATE'
-                            with m.Case(USBAnalyzerVendorRequests.GET_SPEEDS):
-                                m.next = 'GET_SPEEDS'
                             with m.Case(USBAnalyzerVendorRequests.SET_TEST_CONFIG):
                                 m.next = 'SET_TEST_CONFIG'
-                            with m.Case(USBAnalyzerVendorRequests.GET_MINOR_VERSION):
-                                m.next = 'GET_MINOR_VERSION'
-                            with m.Case(USBAnalyzerVendorRequests.GET_TRIGGER_CAPS):
-                                m.next = 'GET_TRIGGER_CAPS'
                             with m.Case(USBAnalyzerVendorRequests.SET_TRIGGER_CONTROL):
                                 m.d.usb += [
                                     rx_count.eq(0),
@@ -302,76 +532,53 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
                             with m.Case(USBAnalyzerVendorRequests.SET_TRIGGER_STAGE):
                                 m.d.usb += rx_count.eq(0)
                                 m.next = 'SET_TRIGGER_STAGE'
-                            with m.Case(USBAnalyzerVendorRequests.GET_TRIGGER_STATUS):
-                                m.next = 'GET_TRIGGER_STATUS'
                             with m.Case(USBAnalyzerVendorRequests.ARM_TRIGGER):
-                                m.next = 'ARM_TRIGGER'
+                                m.d.usb += arm_request.eq(1)
+                                m.next = 'ARM_DISARM_TRIGGER'
                             with m.Case(USBAnalyzerVendorRequests.DISARM_TRIGGER):
-                                m.next = 'DISARM_TRIGGER'
+                                m.d.usb += arm_request.eq(0)
+                                m.next = 'ARM_DISARM_TRIGGER'
                             with m.Case(USBAnalyzerVendorRequests.GET_TRIGGER_STAGE):
                                 m.next = 'GET_TRIGGER_STAGE'
 
-                # GET_STATE -- Fetch the device's state
-                with m.State('GET_STATE'):
-                    self.handle_simple_data_request(m, simple_transmitter, self.state.current, length=1)
+                # GET_SIMPLE_DATA -- Return one of the short read-only
+                # replies selected above.
+                with m.State('GET_SIMPLE_DATA'):
+                    m.d.comb += [
+                        simple_transmitter.stream.attach(interface.tx),
+                        Cat(simple_transmitter.data).eq(simple_payload),
+                        simple_transmitter.max_length.eq(simple_length),
+                    ]
+
+                    with m.If(interface.data_requested):
+                        m.d.comb += simple_transmitter.start.eq(1)
+
+                    with m.If(interface.status_requested):
+                        m.d.comb += interface.handshakes_out.ack.eq(1)
+                        m.next = 'IDLE'
 
                 # SET_STATE -- The host is trying to set our state
                 with m.State('SET_STATE'):
                     self.handle_register_write_request(m, self.state.next, self.state.write)
 
-                # GET_SPEEDS -- Fetch the device's supported USB speeds
-                with m.State('GET_SPEEDS'):
-                    supported_speeds = \
-                        USBAnalyzerSupportedSpeeds.USB_SPEED_LOW | \
-                        USBAnalyzerSupportedSpeeds.USB_SPEED_FULL | \
-                        USBAnalyzerSupportedSpeeds.USB_SPEED_HIGH
-
-                    # Automatic speed detection is only supported on Cynthion r0.6+.
-                    if platform.version >= (0, 6):
-                        supported_speeds |= \
-                            USBAnalyzerSupportedSpeeds.USB_SPEED_AUTO
-
-                    self.handle_simple_data_request(m, simple_transmitter, supported_speeds, length=1)
-
                 # SET_TEST_CONFIG -- The host is trying to configure our test device
                 with m.State('SET_TEST_CONFIG'):
                     self.handle_register_write_request(m, self.test_config.next, self.test_config.write)
 
-                # GET_STATE -- Fetch the device's state
-                with m.State('GET_MINOR_VERSION'):
-                    self.handle_simple_data_request(m, simple_transmitter, C(MINOR_VERSION), length=1)
-
-                # GET_TRIGGER_CAPS -- Trigger engine capabilities.
-                with m.State('GET_TRIGGER_CAPS'):
-                    caps = Cat(
-                        C(self.trigger.max_stages, 8),
-                        C(self.trigger.max_pattern, 8),
-                        C(TRIGGER_STAGE_PAYLOAD_LEN & 0xFF, 8),
-                        C((TRIGGER_STAGE_PAYLOAD_LEN >> 8) & 0xFF, 8),
-                    )
-                    self.handle_simple_data_request(
-                        m,
-                        simple_transmitter,
-                        caps,
-                        length=TRIGGER_CAPS_PAYLOAD_LEN,
-                    )
-
                 # SET_TRIGGER_CONTROL -- Configure trigger globals.
                 with m.State('SET_TRIGGER_CONTROL'):
-                    stage_count_clamped = Mux(
-                        control_stage_count > self.trigger.max_stages,
-                        self.trigger.max_stages,
-                        control_stage_count,
-                    )
-
-                    m.d.comb += interface.claim.eq(1)
-
                     with m.If(interface.rx.valid & interface.rx.next):
                         with m.Switch(rx_count):
                             with m.Case(0):
                                 m.d.usb += control_flags.eq(interface.rx.payload)
                             with m.Case(1):
-                                m.d.usb += control_stage_count.eq(interface.rx.payload)
+                                # Clamp the stage count as it arrives, so it can
+                                # be committed as-is.
+                                m.d.usb += control_stage_count.eq(Mux(
+                                    interface.rx.payload > self.trigger.max_stages,
+                                    self.trigger.max_stages,
+                                    interface.rx.payload,
+                                ))
                         with m.If(rx_count < TRIGGER_CONTROL_PAYLOAD_LEN):
                             m.d.usb += rx_count.eq(rx_count + 1)
 
@@ -380,7 +587,7 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
                         m.d.usb += [
                             self.trigger.enable.eq(control_flags[0]),
                             self.trigger.output_enable.eq(control_flags[1]),
-                            self.trigger.stage_count.eq(stage_count_clamped),
+                            self.trigger.stage_count.eq(control_stage_count),
                         ]
                         with m.If(~control_flags[0]):
                             m.d.usb += self.trigger.armed.eq(0)
@@ -392,43 +599,19 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
 
                 # SET_TRIGGER_STAGE -- Configure one trigger stage.
                 with m.State('SET_TRIGGER_STAGE'):
-                    m.d.comb += interface.claim.eq(1)
-
                     with m.If(interface.rx.valid & interface.rx.next):
                         with m.If(valid_stage_index):
                             with m.Switch(rx_count):
                                 with m.Case(0):
-                                    m.d.usb += self.trigger.stage_offsets[stage_index][0:8].eq(interface.rx.payload)
+                                    m.d.comb += self.trigger.stage_write_en.eq(0b001)
                                 with m.Case(1):
-                                    m.d.usb += self.trigger.stage_offsets[stage_index][8:16].eq(interface.rx.payload)
+                                    m.d.comb += self.trigger.stage_write_en.eq(0b010)
                                 with m.Case(2):
-                                    m.d.usb += self.trigger.stage_lengths[stage_index].eq(
-                                        Mux(
-                                            interface.rx.payload > self.trigger.max_pattern,
-                                            self.trigger.max_pattern,
-                                            interface.rx.payload,
-                                        )
-                                    )
-                                with m.Case(3):
-                                    pass
-                                for i in range(TRIGGER_MAX_PATTERN_BYTES):
-                                    with m.Case(4 + i):
-                                        flat_index = Cat(C(i, self.trigger.pattern_bits), stage_index)
-                                        m.d.usb += self.trigger.patterns_flat[flat_index].eq(interface.rx.payload)
-                                        m.d.comb += [
-                                            self.trigger.pattern_write_en.eq(1),
-                                            self.trigger.pattern_write_addr.eq(flat_index),
-                                            self.trigger.pattern_write_data.eq(interface.rx.payload),
-                                        ]
-                                for i in range(TRIGGER_MAX_PATTERN_BYTES):
-                                    with m.Case(4 + TRIGGER_MAX_PATTERN_BYTES + i):
-                                        flat_index = Cat(C(i, self.trigger.pattern_bits), stage_index)
-                                        m.d.usb += self.trigger.masks_flat[flat_index].eq(interface.rx.payload)
-                                        m.d.comb += [
-                                            self.trigger.mask_write_en.eq(1),
-                                            self.trigger.mask_write_addr.eq(flat_index),
-                                            self.trigger.mask_write_data.eq(interface.rx.payload),
-                                        ]
+                                    m.d.comb += self.trigger.stage_write_en.eq(0b100)
+                            m.d.comb += [
+                                self.trigger.pattern_write_en.eq(rx_is_pattern),
+                                self.trigger.mask_write_en.eq(rx_is_mask),
+                            ]
                         with m.If(rx_count < TRIGGER_STAGE_PAYLOAD_LEN):
                             m.d.usb += rx_count.eq(rx_count + 1)
 
@@ -445,63 +628,21 @@ class USBAnalyzerVendorRequestHandler(ControlRequestHandler):
                             m.d.comb += interface.handshakes_out.stall.eq(1)
                         m.next = 'IDLE'
 
-                # GET_TRIGGER_STATUS -- Read trigger runtime state.
-                with m.State('GET_TRIGGER_STATUS'):
-                    status = Cat(
-                        status_flags,
-                        status_sequence_stage,
-                        self.trigger.fire_count[0:8],
-                        self.trigger.fire_count[8:16],
-                        status_stage_count,
-                    )
-                    self.handle_simple_data_request(
-                        m,
-                        simple_transmitter,
-                        status,
-                        length=TRIGGER_STATUS_PAYLOAD_LEN,
-                    )
-
-                # ARM_TRIGGER -- Enable armed matching state.
-                with m.State('ARM_TRIGGER'):
-                    m.d.comb += interface.claim.eq(1)
-                    with m.If(interface.status_requested):
-                        m.d.usb += self.trigger.armed.eq(1)
-                        m.d.comb += [
-                            self.trigger.arm_strobe.eq(1),
-                            self.send_zlp(),
-                        ]
-                        m.next = 'IDLE'
-
-                # DISARM_TRIGGER -- Disable matching state and reset sequence.
-                with m.State('DISARM_TRIGGER'):
-                    m.d.comb += interface.claim.eq(1)
+                # ARM_DISARM_TRIGGER -- Enable armed matching state, or disable
+                # it and reset the sequence, as chosen by the request.
+                with m.State('ARM_DISARM_TRIGGER'):
                     with m.If(interface.status_requested):
-                        m.d.usb += self.trigger.armed.eq(0)
+                        m.d.usb += self.trigger.armed.eq(arm_request)
                         m.d.comb += [
-                            self.trigger.disarm_strobe.eq(1),
+                            self.trigger.arm_strobe.eq(arm_request),
+                            self.trigger.disarm_strobe.eq(~arm_request),
                             self.send_zlp(),
                         ]
                         m.next = 'IDLE'
 
                 # GET_TRIGGER_STAGE -- Read trigger stage config.
                 with m.State('GET_TRIGGER_STAGE'):
-                    m.d.comb += [
-                        interface.claim.eq(1),
-                        stage_transmitter.stream.attach(interface.tx),
-                        stage_transmitter.max_length.eq(TRIGGER_STAGE_PAYLOAD_LEN),
-                        stage_transmitter.data[0].eq(self.trigger.stage_offsets[stage_index][0:8]),
-                        stage_transmitter.data[1].eq(self.trigger.stage_offsets[stage_index][8:16]),
-                        stage_transmitter.data[2].eq(self.trigger.stage_lengths[stage_index]),
-                        stage_transmitter.data[3].eq(C(0, 8)),
-                    ]
-                    for i in range(TRIGGER_MAX_PATTERN_BYTES):
-                        flat_index = Cat(C(i, self.trigger.pattern_bits), stage_index)
-                        m.d.comb += stage_transmitter.data[4 + i].eq(self.trigger.patterns_flat[flat_index])
-                    for i in range(TRIGGER_MAX_PATTERN_BYTES):
-                        flat_index = Cat(C(i, self.trigger.pattern_bits), stage_index)
-                        m.d.comb += stage_transmitter.data[4 + TRIGGER_MAX_PATTERN_BYTES + i].eq(
-                            self.trigger.masks_flat[flat_index]
-                        )
+                    m.d.comb += stage_transmitter.stream.attach(interface.tx)
 
                     with m.If(interface.data_requested):
                         with m.If(valid_stage_index):
@@ -527,6 +668,18 @@ class USBAnalyzerApplet(Elaboratable):
         - DRAM backing for analysis
     """
 
+    # Depth of the on-chip FIFO behind the HyperRAM, in 16-bit words. Host
+    # scheduling gaps back up into the HyperRAM itself; this FIFO only has
+    # to keep the output fed across HyperRAM refresh and read turnaround
+    # stalls. 512 words is about 17us at the high-speed word rate, and
+    # still occupies a single ECP5 block RAM.
+    PSRAM_OUT_FIFO_DEPTH = 512
+
+    # Build the AnalyzerTestDevice on the AUX PHY (r0.6+ only). It is left
+    # out of release bitstreams; SET_TEST_CONFIG is still accepted, but has
+    # no device to configure.
+    WITH_TEST_DEVICE = False
+
     def create_descriptors(self, platform, sharing):
         """ Create the descriptors we want to use for our device. """
 
@@ -596,6 +749,16 @@ class USBAnalyzerApplet(Elaboratable):
         ulpi = platform.request("target_phy")
         m.submodules.utmi = utmi = UTMITranslator(ulpi=ulpi)
 
+        # Register the line state and VBUS status once, giving the event and
+        # speed detectors a shared buffered copy rather than each loading the
+        # translator's outputs directly.
+        line_state = Signal(2)
+        vbus_connected = Signal()
+        m.d.usb += [
+            line_state.eq(utmi.line_state),
+            vbus_connected.eq(utmi.session_valid),
+        ]
+
         # Add event detectors for fixed speeds.
         m.submodules.hs_event = hs_event_detector = USBHighSpeedEventDetector()
         m.submodules.fs_event = fs_event_detector = USBFullSpeedEventDetector()
@@ -604,33 +767,33 @@ class USBAnalyzerApplet(Elaboratable):
             hs_event_detector.reset.eq(state.write),
             fs_event_detector.reset.eq(state.write),
             ls_event_detector.reset.eq(state.write),
-            fs_event_detector.line_state.eq(utmi.line_state),
-            ls_event_detector.line_state.eq(utmi.line_state),
-            hs_event_detector.vbus_connected.eq(utmi.session_valid),
-            fs_event_detector.vbus_connected.eq(utmi.session_valid),
-            ls_event_detector.vbus_connected.eq(utmi.session_valid),
+            fs_event_detector.line_state.eq(line_state),
+            ls_event_detector.line_state.eq(line_state),
+            hs_event_detector.vbus_connected.eq(vbus_connected),
+            fs_event_detector.vbus_connected.eq(vbus_connected),
+            ls_event_detector.vbus_connected.eq(vbus_connected),
         ]
 
         # Connect our power controls. The power_control_enable bit must be set
         # to use this feature, otherwise the default pass-through is enabled.
         power_control_enable = state.current[USBAnalyzerState.POWER_CONTROL_ENABLE]
         if platform.version >= (0, 6):
+            # Select all the VBUS switch controls with one 4-bit Mux; with
+            # power control disabled, only TARGET-C passthrough is enabled.
+            vbus_controls = Mux(power_control_enable,
+                Cat(state.current[USBAnalyzerState.VBUS_FROM_TARGET_C],
+                    state.current[USBAnalyzerState.VBUS_FROM_CONTROL_HOST],
+                    state.current[USBAnalyzerState.VBUS_FROM_AUX],
+                    state.current[USBAnalyzerState.VBUS_TARGET_A_DISCHARGE]),
+                C(0b0001, 4))
             m.d.comb += [
                 # Connect all the VBUS switch controls.
-                platform.request("target_c_vbus_en").o.eq(
-                    Mux(power_control_enable,
-                        state.current[USBAnalyzerState.VBUS_FROM_TARGET_C], True)),
-                platform.request("control_vbus_en").o.eq(
-                    Mux(power_control_enable,
-                        state.current[USBAnalyzerState.VBUS_FROM_CONTROL_HOST], False)),
-                platform.request("aux_vbus_en").o.eq(
-                    Mux(power_control_enable,
-                        state.current[USBAnalyzerState.VBUS_FROM_AUX], False)),
+                platform.request("target_c_vbus_en").o.eq(vbus_controls[0]),
+                platform.request("control_vbus_en").o.eq(vbus_controls[1]),
+                platform.request("aux_vbus_en").o.eq(vbus_controls[2]),
 
                 # And the TARGET-A discharge control.
-                platform.request("target_a_discharge").o.eq(
-                    Mux(power_control_enable,
-                        state.current[USBAnalyzerState.VBUS_TARGET_A_DISCHARGE], False)),
+                platform.request("target_a_discharge").o.eq(vbus_controls[3]),
             ]
 
             # Tap the D+/D- signals for speed detection.
@@ -659,26 +822,25 @@ class USBAnalyzerApplet(Elaboratable):
             # Provide the necessary signals for speed detection.
             m.d.comb += [
                 speed_detector.reset.eq(state.write),
-                speed_detector.line_state.eq(utmi.line_state),
+                speed_detector.line_state.eq(line_state),
                 speed_detector.usb_dp.eq(usb_dp),
                 speed_detector.usb_dm.eq(usb_dm),
-                speed_detector.vbus_connected.eq(utmi.session_valid),
+                speed_detector.vbus_connected.eq(vbus_connected),
             ]
 
         else:
+            # On the r0.1 to r0.5 boards, power switching is different.
+            vbus_controls = Mux(power_control_enable,
+                Cat(state.current[USBAnalyzerState.VBUS_FROM_TARGET_C],
+                    state.current[USBAnalyzerState.VBUS_FROM_CONTROL_HOST]),
+                C(0b01, 2))
             m.d.comb += [
-                # On the r0.1 to r0.5 boards, power switching is different.
-
                 # `pass_through_vbus` is equivalent to `target_c_vbus_en`
                 # and controls VBUS from TARGET-C to TARGET-A.
-                platform.request("pass_through_vbus").o.eq(
-                    Mux(power_control_enable,
-                        state.current[USBAnalyzerState.VBUS_FROM_TARGET_C], True)),
+                platform.request("pass_through_vbus").o.eq(vbus_controls[0]),
 
                 # `power_a_port` controls VBUS from HOST to TARGET-A.
-                platform.request("power_a_port").o.eq(
-                    Mux(power_control_enable,
-                        state.current[USBAnalyzerState.VBUS_FROM_CONTROL_HOST], False)),
+                platform.request("power_a_port").o.eq(vbus_controls[1]),
 
                 # There is no way of powering TARGET-A from the SIDEBAND
                 # port, and no discharge capability on TARGET-A.
@@ -689,23 +851,15 @@ class USBAnalyzerApplet(Elaboratable):
             auto_event_strobe = False
             auto_event_code = USBAnalyzerEvent.NONE
 
-        # Choose the appropriate event source according to speed selection.
-        event_strobes = Array([
-            hs_event_detector.event_strobe,
-            fs_event_detector.event_strobe,
-            ls_event_detector.event_strobe,
-            auto_event_strobe,
-        ])
+        # Choose the appropriate event source according to speed selection:
+        # 0b00 = HS, 0b01 = FS, 0b10 = LS, 0b11 = auto.
+        event_strobe = Mux(speed_selection[1],
+            Mux(speed_selection[0], auto_event_strobe, ls_event_detector.event_strobe),
+            Mux(speed_selection[0], fs_event_detector.event_strobe, hs_event_detector.event_strobe))
 
-        event_codes = Array([
-            hs_event_detector.event_code,
-            fs_event_detector.event_code,
-            ls_event_detector.event_code,
-            auto_event_code,
-        ])
-
-        event_strobe = event_strobes[speed_selection]
-        event_code = event_codes[speed_selection]
+        event_code = Mux(speed_selection[1],
+            Mux(speed_selection[0], auto_event_code, ls_event_detector.event_code),
+            Mux(speed_selection[0], fs_event_detector.event_code, hs_event_detector.event_code))
 
         # Set up our parameters.
         m.d.comb += [
@@ -722,8 +876,9 @@ class USBAnalyzerApplet(Elaboratable):
         if platform.version >= (0, 6):
             phy_name = "control_phy"
 
-            # Also set up a test device on the AUX PHY.
-            m.submodules += AnalyzerTestDevice(test_config)
+            # Also set up a test device on the AUX PHY, if requested.
+            if self.WITH_TEST_DEVICE:
+                m.submodules += AnalyzerTestDevice(test_config)
         else:
             phy_name = "host_phy"
 
@@ -738,27 +893,15 @@ class USBAnalyzerApplet(Elaboratable):
         descriptors = self.create_descriptors(platform, sharing)
 
         # Add Microsoft OS 1.0 descriptors for Windows compatibility.
-        descriptors.add_descriptor(get_string_descriptor("MSFT100\xee"), index=0xee)
-        msft_descriptors = MicrosoftOS10DescriptorCollection()
-        with msft_descriptors.ExtendedCompatIDDescriptor() as c:
-            with c.Function() as f:
-                f.bFirstInterfaceNumber = 0
-                f.compatibleID          = 'WINUSB'
-            if sharing is not None:
-                with c.Function() as f:
-                    f.bFirstInterfaceNumber = 1
-                    f.compatibleID          = 'WINUSB'
-        with msft_descriptors.ExtendedPropertiesDescriptor() as d:
-            with d.Property() as p:
-                p.dwPropertyDataType = RegistryTypes.REG_SZ
-                p.PropertyName       = "DeviceInterfaceGUID"
-                p.PropertyData       = "{88bae032-5a81-49f0-bc3d-a4ff138216d6}"
+        descriptors.add_descriptor(MSFT_OS_STRING_DESCRIPTOR, index=0xee)
+        msft_descriptors = _build_msft_descriptors(
+            1 if sharing is None else 2, ANALYZER_INTERFACE_GUID)
 
         # Add our standard control endpoint to the device.
         control_endpoint = usb.add_standard_control_endpoint(descriptors)
 
         # Add handler for Microsoft descriptors.
-        msft_handler = MicrosoftOS10RequestHandler(msft_descriptors, request_code=0xee)
+        msft_handler = MicrosoftOS10RequestHandler(msft_descriptors, request_code=MSFT_VENDOR_CODE)
         control_endpoint.add_request_handler(msft_handler)
 
         # Add our vendor request handler to the control endpoint.
@@ -801,17 +944,33 @@ class USBAnalyzerApplet(Elaboratable):
         with m.Else():
             m.d.usb += capture_sync_counter.eq(capture_sync_counter + 1)
 
-        # Follow this with a HyperRAM FIFO for additional buffering.
+        # Give the analyzer's output some elasticity ahead of the HyperRAM,
+        # covering the write command setup during which the HyperRAM FIFO
+        # can't accept data. Each entry carries a word and its `last` flag.
         reset_on_start = ResetInserter(analyzer.starting)
+        m.submodules.ingress_fifo = ingress_fifo = reset_on_start(
+            SyncFIFOBuffered(width=17, depth=32))
+
+        # Follow this with a HyperRAM FIFO for additional buffering.
         m.submodules.psram_fifo = psram_fifo = reset_on_start(
-            HyperRAMPacketFIFO(out_fifo_depth=128))
+            HyperRAMPacketFIFO(out_fifo_depth=self.PSRAM_OUT_FIFO_DEPTH))
 
-        # Convert the 16-bit stream into an 8-bit one for output.
-        m.submodules.s16to8 = s16to8 = reset_on_start(Stream16to8())
+        # Count buffer overruns, and the cycles on which the HyperRAM FIFO
+        # held off input while the analyzer had data, so hosts can tell
+        # whether the buffering keeps up.
+        m.submodules.overrun_counters = overrun_counters = USBAnalyzerOverrunCounters()
 
         # Add a special stream clock converter for 'sync' to 'usb' crossing.
+        # It is deep enough to ride out the pointer synchronization latency
+        # without running dry between bursts, and carries whole 16-bit words
+        # so that only one token crosses per captured word.
         m.submodules.clk_conv = clk_conv = StreamFIFO(
-            AsyncFIFOReadReset(width=8, depth=4, r_domain="usb", w_domain="sync"))
+            AsyncFIFOReadReset(width=16, depth=16, r_domain="usb", w_domain="sync"))
+
+        # Convert the 16-bit stream into an 8-bit one for output, on the
+        # 'usb' side of the crossing.
+        m.submodules.s16to8 = s16to8 = ResetInserter({"usb": analyzer.starting})(
+            DomainRenamer("usb")(Stream16to8()))
 
         m.d.comb += [
             # Connect enable signal to host-controlled state register.
@@ -822,6 +981,13 @@ class USBAnalyzerApplet(Elaboratable):
             trigger.trigger_out         .eq(analyzer.trigger_output),
             trigger.fire_count          .eq(analyzer.trigger_fire_count),
 
+            # Overrun and stall counts exported to host over vendor requests.
+            overrun_counters.overrun    .eq(analyzer.overrun),
+            overrun_counters.starting   .eq(analyzer.starting),
+            overrun_counters.stalled    .eq(analyzer.stream.valid & ~psram_fifo.input.ready),
+            vendor_request_handler.overrun_count.eq(overrun_counters.overrun_count),
+            vendor_request_handler.stall_count.eq(overrun_counters.stall_count),
+
             # Flush endpoint when analyzer is idle with capture disabled.
             stream_ep.flush             .eq(analyzer.idle & ~analyzer.capture_enable),
 
@@ -829,34 +995,51 @@ class USBAnalyzerApplet(Elaboratable):
             stream_ep.discard           .eq(analyzer.starting),
 
             # USB stream pipeline.
-            psram_fifo.input            .stream_eq(analyzer.stream),
-            s16to8.input                .stream_eq(psram_fifo.output),
-            clk_conv.input              .stream_eq(s16to8.output),
+            ingress_fifo.w_data         .eq(Cat(analyzer.stream.payload, analyzer.stream.last)),
+            ingress_fifo.w_en           .eq(analyzer.stream.valid),
+            analyzer.stream.ready       .eq(ingress_fifo.w_rdy),
+            psram_fifo.input.payload    .eq(ingress_fifo.r_data[0:16]),
+            psram_fifo.input.last       .eq(ingress_fifo.r_data[16]),
+            psram_fifo.input.valid      .eq(ingress_fifo.r_rdy),
+            ingress_fifo.r_en           .eq(psram_fifo.input.ready),
+            clk_conv.input              .stream_eq(psram_fifo.output),
             clk_conv.fifo.ext_rst       .eq(analyzer.starting),
-            stream_ep.stream            .stream_eq(clk_conv.output),
+            s16to8.input                .stream_eq(clk_conv.output),
+            stream_ep.stream            .stream_eq(s16to8.output),
 
             usb.connect                 .eq(1),
-
-            # LED indicators.
-            platform.request("led", 0).o  .eq(capture_sync_signal),
-            platform.request("led", 1).o  .eq(stream_ep.stream.valid),
-            platform.request("led", 2).o  .eq(analyzer.overrun),
-
-            platform.request("led", 3).o  .eq(utmi.session_valid),
-            platform.request("led", 4).o  .eq(utmi.rx_active),
-            platform.request("led", 5).o  .eq(utmi.rx_error),
         ]
 
+        # LED indicators. These are registered, keeping the LED pins off the
+        # end of the paths they monitor; a cycle of delay is invisible here.
+        leds = Signal(6)
+        m.d.usb += leds.eq(Cat(
+            capture_sync_signal,
+            stream_ep.stream.valid,
+            analyzer.overrun,
+
+            utmi.session_valid,
+            utmi.rx_active,
+            utmi.rx_error,
+        ))
+        m.d.comb += [platform.request("led", i).o.eq(leds[i]) for i in range(6)]
+
         # Route trigger output to PMOD A1 and the capture sync square wave to PMOD A2.
         try:
             trigger_pmod = platform.request("user_pmod", 0)
+
+            # Register the trigger pulse, so the pin is driven straight from
+            # a flop rather than from the end of the trigger logic.
+            trigger_pin = Signal()
+            m.d.usb += trigger_pin.eq(trigger.output_enable & analyzer.trigger_output)
+
             m.d.comb += [
                 # user_pmod has a shared OE; drive the full bus deterministically
                 # with PMOD A1 carrying the trigger pulse and PMOD A2 carrying
                 # the slow capture sync square wave.
                 trigger_pmod.oe.eq(1),
                 trigger_pmod.o.eq(Cat(
-                    trigger.output_enable & analyzer.trigger_output,
+                    trigger_pin,
                     capture_sync_signal,
                     C(0, 7),
                 )),
@@ -891,10 +1074,18 @@ class AnalyzerTestDevice(Elaboratable):
         USBSpeed.LOW: 3,
     }
 
-    def __init__(self, config):
+    def __init__(self, config, enabled_speeds=SPEEDS):
         self.config = config
 
-    def create_descriptors(self, speed):
+        # Only the speeds listed here get a request handler and an IN
+        # endpoint; the rest cost no gateware at all.
+        self.enabled_speeds = tuple(enabled_speeds)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def create_descriptors(cls, speed):
+        # The descriptors only depend on the speed, so each speed's tree is
+        # built once and shared between instances and elaborations.
         descriptors = DeviceDescriptorCollection()
 
         with descriptors.DeviceDescriptor() as d:
@@ -904,19 +1095,18 @@ class AnalyzerTestDevice(Elaboratable):
             d.iProduct           = "USB Analyzer Test Device"
             d.bcdDevice          = 0.01
             d.bNumConfigurations = 1
-            d.bMaxPacketSize0    = self.EP0_MAX_SIZE[speed]
+            d.bMaxPacketSize0    = cls.EP0_MAX_SIZE[speed]
 
         with descriptors.ConfigurationDescriptor() as c:
             with c.InterfaceDescriptor() as i:
                 i.bInterfaceNumber = 0
                 with i.EndpointDescriptor() as e:
-                    e.bEndpointAddress = 0x80 | self.INT_EP_NUM[speed]
+                    e.bEndpointAddress = 0x80 | cls.INT_EP_NUM[speed]
                     e.bmAttributes     = 0x03 # Interrupt endpoint
-                    e.wMaxPacketSize   = self.INT_EP_MAX_SIZE[speed]
+                    e.wMaxPacketSize   = cls.INT_EP_MAX_SIZE[speed]
                     e.bInterval        = 0x05 # 5ms interval
 
-        descriptors.add_descriptor(
-                get_string_descriptor("MSFT100\xee"), index=0xee)
+        descriptors.add_descriptor(MSFT_OS_STRING_DESCRIPTOR, index=0xee)
 
         return descriptors
 
@@ -935,31 +1125,32 @@ class AnalyzerTestDevice(Elaboratable):
         # Create control endpoint.
         control_ep = USBControlEndpoint(utmi=usb.utmi)
 
-        # Add standard request handlers for each speed.
-        for speed in self.SPEEDS:
+        # Add standard request handlers for each speed. With a single speed
+        # enabled there is nothing to choose between, so no blacklist.
+        for speed in self.enabled_speeds:
+            if len(self.enabled_speeds) > 1:
+                blacklist = [lambda setup,speed=speed: current_speed != speed]
+            else:
+                blacklist = []
             handler = StandardRequestHandler(
                 self.create_descriptors(speed),
                 self.EP0_MAX_SIZE[speed],
-                blacklist=[lambda setup,speed=speed: current_speed != speed])
+                blacklist=blacklist)
             control_ep.add_request_handler(handler)
 
         # Add Microsoft descriptors for Windows compatibility.
-        msft_descriptors = MicrosoftOS10DescriptorCollection()
-        with msft_descriptors.ExtendedCompatIDDescriptor() as c:
-            with c.Function() as f:
-                f.bFirstInterfaceNumber = 0
-                f.compatibleID          = 'WINUSB'
+        msft_descriptors = _build_msft_descriptors(1)
 
         # Add handler for Microsoft descriptors.
         msft_handler = MicrosoftOS10RequestHandler(
-                msft_descriptors, request_code=0xee)
+                msft_descriptors, request_code=MSFT_VENDOR_CODE)
         control_ep.add_request_handler(msft_handler)
 
         # Add control endpoint.
         usb.add_endpoint(control_ep)
 
         # Add IN endpoints for each speed.
-        for speed in self.SPEEDS:
+        for speed in self.enabled_speeds:
             in_ep = USBStreamInEndpoint(
                 endpoint_number=self.INT_EP_NUM[speed],
                 max_packet_size=self.INT_EP_MAX_SIZE[speed])
@@ -977,5 +1168,121 @@ class AnalyzerTestDevice(Elaboratable):
         return m
 
 
+class USBAnalyzerOverrunCountersTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = USBAnalyzerOverrunCounters
+
+    USB_CLOCK_FREQUENCY = 60e6
+    SYNC_CLOCK_FREQUENCY = 120e6
+
+    @usb_domain_test_case
+    def test_overrun_count(self):
+        dut = self.dut
+
+        # A latched overrun counts once, however long it stays latched.
+        yield dut.overrun.eq(1)
+        yield from self.advance_cycles(4)
+        self.assertEqual((yield dut.overrun_count), 1)
+
+        # Clearing it and overrunning again counts a second overrun.
+        yield dut.overrun.eq(0)
+        yield from self.advance_cycles(2)
+        yield dut.overrun.eq(1)
+        yield from self.advance_cycles(2)
+        self.assertEqual((yield dut.overrun_count), 2)
+
+        # Starting a capture doesn't clear the overrun count.
+        yield from self.pulse(dut.starting)
+        self.assertEqual((yield dut.overrun_count), 2)
+
+    @usb_domain_test_case
+    def test_stall_count(self):
+        dut = self.dut
+
+        # Stalled cycles are counted in the sync domain, at two per usb cycle.
+        yield dut.stalled.eq(1)
+        yield from self.advance_cycles(3)
+        yield dut.stalled.eq(0)
+        yield
+        self.assertEqual((yield dut.stall_count), 6)
+
+        # The count holds while nothing is stalled...
+        yield from self.advance_cycles(3)
+        self.assertEqual((yield dut.stall_count), 6)
+
+        # ... and restarts with each capture.
+        yield from self.pulse(dut.starting)
+        self.assertEqual((yield dut.stall_count), 0)
+
+    @usb_domain_test_case
+    def test_stall_count_saturates(self):
+        dut = self.dut
+
+        yield dut.stall_count.eq(0xFFFFFFFE)
+        yield dut.stalled.eq(1)
+        yield from self.advance_cycles(2)
+        self.assertEqual((yield dut.stall_count), 0xFFFFFFFF)
+
+
+class USBAnalyzerVendorRequestHandlerTest(LunaGatewareTestCase):
+    USB_CLOCK_FREQUENCY = 60e6
+    SYNC_CLOCK_FREQUENCY = None
+
+    def instantiate_dut(self):
+        self.handler = USBAnalyzerVendorRequestHandler(
+            USBAnalyzerRegister(), USBAnalyzerRegister(), USBAnalyzerTriggerConfig())
+
+        # The handler only looks at the platform for its board revision.
+        return self.handler.elaborate(SimpleNamespace(version=(1, 4)))
+
+    def initialize_signals(self):
+        yield self.handler.overrun_count.eq(0x12345678)
+        yield self.handler.stall_count.eq(0x0000ABCD)
+        yield
+
+    def send_setup(self, request, *, is_in_request):
+        setup = self.handler.interface.setup
+        yield setup.type.eq(USBRequestType.VENDOR)
+        yield setup.recipient.eq(USBRequestRecipient.INTERFACE)
+        yield setup.index.eq(0)
+        yield setup.request.eq(request)
+        yield setup.is_in_request.eq(is_in_request)
+        yield from self.pulse(setup.received)
+
+    def receive_data(self):
+        interface = self.handler.interface
+
+        # Ask for the data stage, then collect bytes until the last one.
+        yield from self.pulse(interface.data_requested, step_after=False)
+        yield interface.tx.ready.eq(1)
+        received_data = []
+        for _ in range(32):
+            yield
+            if (yield interface.tx.valid):
+                received_data.append((yield interface.tx.payload))
+                if (yield interface.tx.last):
+                    break
+        yield interface.tx.ready.eq(0)
+        return bytes(received_data)
+
+    @usb_domain_test_case
+    def test_get_overrun_count(self):
+        yield from self.send_setup(USBAnalyzerVendorRequests.GET_OVERRUN_COUNT, is_in_request=True)
+        self.assertEqual((yield self.handler.interface.claim), 1)
+
+        # The reply is the overrun count, then the stall count, both
+        # little-endian.
+        received_data = yield from self.receive_data()
+        self.assertEqual(len(received_data), OVERRUN_COUNT_PAYLOAD_LEN)
+        self.assertEqual(received_data, bytes([0x78, 0x56, 0x34, 0x12, 0xCD, 0xAB, 0x00, 0x00]))
+
+    @usb_domain_test_case
+    def test_unassigned_request_unclaimed(self):
+        yield from self.send_setup(8, is_in_request=True)
+        self.assertEqual((yield self.handler.interface.claim), 0)
+
+        yield from self.send_setup(USBAnalyzerVendorRequests.GET_OVERRUN_COUNT + 1, is_in_request=True)
+        self.assertEqual((yield self.handler.interface.claim), 0)
+
+
 if __name__ == "__main__":
     top_level_cli(USBAnalyzerApplet)
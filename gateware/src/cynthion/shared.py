@@ -2,16 +2,16 @@
 
 """Shared USB constants used by standalone analyzer gateware."""
 
-from collections import namedtuple
+from types import SimpleNamespace
 
 
-def _dict_to_namedtuple(data, typename="_"):
-    return namedtuple(typename, data.keys())(
-        *(_dict_to_namedtuple(v, typename + "_" + k) if isinstance(v, dict) else v for k, v in data.items())
+def _dict_to_namespace(data):
+    return SimpleNamespace(
+        **{k: _dict_to_namespace(v) if isinstance(v, dict) else v for k, v in data.items()}
     )
 
 
-usb = _dict_to_namedtuple(
+usb = _dict_to_namespace(
     {
         "bVendorId": {
             "apollo": 0x1D50,